@@ -0,0 +1,172 @@
+"""End-to-end benchmark of Nodulegeneration on synthetic CXR stacks.
+
+Writes --images synthetic .mha stacks of --slices 1024x1024 slices and a nodules.json with
+on average --nodules_per_slice boxes per slice, drawn with create_random_bboxes (box sizes
+scaled by --box_scale), runs Nodulegeneration(**--options).process() on them and prints the
+percentiles of the batch time per nodule, images/sec, the peak RSS of the processing and per-stage time
+statistics as JSON.
+Run from the repository root (the weights are read from model_submission/model), e.g.
+python -m benchmarks.end_to_end --options '{"backend": "onnx", "batch_size": 8}'
+"""
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import SimpleITK
+
+from model_submission.utils.bbox import create_random_bboxes
+from model_submission.utils.timing import HistogramSink, StageTimer
+from process import Nodulegeneration
+
+IMAGE_SIZE = 1024
+# boxes have to fit in the crops of Nodulegeneration
+CROP_SIZE = 256
+
+
+def synthetic_cxr(rng, size=IMAGE_SIZE):
+    """Bright body with two darker lung fields and noise, in the 12 bit range of the challenge images."""
+    yy, xx = np.mgrid[0:size, 0:size] / size
+    lungs = sum(np.exp(-((xx - cx) / 0.13) ** 2 - ((yy - 0.5) / 0.28) ** 2) for cx in (0.3, 0.7))
+    image = 2800 - 1400 * lungs + rng.normal(0, 80, (size, size))
+    return image.clip(0, 4095).astype(np.uint16)
+
+
+def nodule_corners(mask_bbox, j):
+    # corners as in nodules.json, corners[0] is (x_max, y_max) and corners[2] is (x_min, y_min)
+    x, y, w, h = mask_bbox
+    return [[x + w, y + h, j], [x, y + h, j], [x, y, j], [x + w, y, j]]
+
+
+def write_dataset(input_path, images, slices, nodules_per_slice, box_scale, seed=0):
+    """Writes the synthetic stacks and returns their nodules.json content, which is shared by all stacks."""
+    rng = np.random.default_rng(seed)
+    boxes = []
+    for j in range(slices):
+        for x, y, w, h in create_random_bboxes(rng.poisson(nodules_per_slice), rng=rng):
+            w = int(min(max(w * box_scale, 1), IMAGE_SIZE - x, CROP_SIZE))
+            h = int(min(max(h * box_scale, 1), IMAGE_SIZE - y, CROP_SIZE))
+            boxes.append({"corners": nodule_corners([x, y, w, h], j), "probability": 1})
+    nodules = {"type": "Multiple 2D bounding boxes", "boxes": boxes, "version": {"major": 1, "minor": 0}}
+    with open(input_path / "nodules.json", "w") as f:
+        json.dump(nodules, f)
+
+    for i in range(images):
+        stack = np.stack([synthetic_cxr(rng) for _ in range(slices)])
+        SimpleITK.WriteImage(SimpleITK.GetImageFromArray(stack), str(input_path / f"synthetic_{i}.mha"), True)
+    return nodules
+
+
+def box_generator_matches_crfill(seed=0, number_of_bboxes=64):
+    """Whether create_random_bboxes draws the same boxes as the one of the crfill training code for the same rng,
+    None when crfill (and its dependencies) can not be imported."""
+    sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "crfill"))
+    try:
+        from data.custom_transformations import create_random_bboxes as crfill_create_random_bboxes
+    except ImportError:
+        return None
+    finally:
+        sys.path.pop(0)
+    return (create_random_bboxes(number_of_bboxes, rng=np.random.default_rng(seed))
+            == crfill_create_random_bboxes(number_of_bboxes, rng=np.random.default_rng(seed)))
+
+
+class TimedNodulegeneration(Nodulegeneration):
+    """Records the time of every generate_batch (or generate_batch_on_device) divided by the nodules of the batch,
+    once per nodule. The nodules of a batch are forwarded together, so this is not the latency of a single crop."""
+
+    def __init__(self, **kwargs):
+        super(TimedNodulegeneration, self).__init__(**kwargs)
+        self.nodule_latencies = []
+
+    def record_latency(self, batch_jobs, elapsed):
+        num_nodules = sum(len(mask_bboxes) for _, _, mask_bboxes, _ in batch_jobs)
+        self.nodule_latencies += [elapsed / num_nodules] * num_nodules
+
+    def generate_batch(self, nodule_images, batch_jobs, cropped_batch):
+        t = time.perf_counter()
+        super(TimedNodulegeneration, self).generate_batch(nodule_images, batch_jobs, cropped_batch)
+        self.record_latency(batch_jobs, time.perf_counter() - t)
+
+    def generate_batch_on_device(self, stack, composed_stack, batch_jobs):
+        t = time.perf_counter()
+        super(TimedNodulegeneration, self).generate_batch_on_device(stack, composed_stack, batch_jobs)
+        self.record_latency(batch_jobs, time.perf_counter() - t)
+
+
+def reset_peak_rss():
+    # resets VmHWM (Linux >= 4.0), so the synthetic data and the model load are not part of the next peak
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def peak_rss_mb():
+    # VmHWM of /proc/self/status is in kilobytes
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+
+
+def run(workdir, images, slices, nodules_per_slice, box_scale, options, seed=0):
+    input_path, output_path = Path(workdir) / "input", Path(workdir) / "output"
+    input_path.mkdir(parents=True, exist_ok=True)
+    nodules = write_dataset(input_path, images, slices, nodules_per_slice, box_scale, seed)
+
+    stage_times = HistogramSink()
+    reset_peak_rss()
+    t = time.perf_counter()
+    algorithm = TimedNodulegeneration(input_path=input_path, output_path=output_path, timer=StageTimer([stage_times]),
+                                      **options)
+    load_time = time.perf_counter() - t
+    load_rss = peak_rss_mb()
+    reset_peak_rss()
+    t = time.perf_counter()
+    algorithm.process()
+    process_time = time.perf_counter() - t
+    process_rss = peak_rss_mb()
+
+    latencies_ms = np.asarray(algorithm.nodule_latencies) * 1000
+    percentiles = {f"p{q}": float(np.percentile(latencies_ms, q)) if len(latencies_ms) else None
+                   for q in (50, 90, 99)}
+    return {
+        "options": options,
+        "images": images,
+        "slices": slices,
+        "nodules": len(nodules["boxes"]) * images,
+        "load_s": load_time,
+        "process_s": process_time,
+        "images_per_s": images / process_time,
+        "batch_ms_per_nodule": percentiles,
+        "load_peak_rss_mb": load_rss,
+        "process_peak_rss_mb": process_rss,
+        "box_generator_matches_crfill": box_generator_matches_crfill(seed),
+        "stages": {name: {k: v for k, v in stats.items() if k != "histogram"}
+                   for name, stats in stage_times.summary().items()},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=4)
+    parser.add_argument('--slices', type=int, default=1)
+    parser.add_argument('--nodules_per_slice', type=float, default=2, help='mean of the Poisson number of boxes')
+    parser.add_argument('--box_scale', type=float, default=1,
+                        help='factor on the create_random_bboxes box sizes, boxes are clamped to the 256x256 crop')
+    parser.add_argument('--options', type=json.loads, default={},
+                        help='keyword arguments of Nodulegeneration as JSON, e.g. \'{"backend": "onnx"}\'')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', type=str, default=None, help='kept after the run, defaults to a temporary one')
+    opt = parser.parse_args()
+
+    workdir = opt.workdir or tempfile.mkdtemp(prefix="nodulegeneration_benchmark_")
+    try:
+        result = run(workdir, opt.images, opt.slices, opt.nodules_per_slice, opt.box_scale, opt.options, opt.seed)
+    finally:
+        if opt.workdir is None:
+            shutil.rmtree(workdir)
+    print(json.dumps(result, indent=4))
@@ -0,0 +1,64 @@
+"""Micro-benchmark of the gated convolutions of the submission generator.
+
+Compares gen_conv/gen_deconv with the fused gate (fused_gate) against the
+split/ELU/sigmoid/mul path with temporaries, at the shapes of BaseConvGenerator
+for 256x256 crops. Run from the repository root with
+python -m benchmarks.gated_conv
+"""
+import argparse
+import json
+import time
+
+import torch
+
+from model_submission.model.utils import enable_cpu_fusion, gen_conv, gen_deconv
+
+CNUM = 48
+# name, layer, input channels, input resolution
+LAYERS = [
+    ("conv1", lambda fused: gen_conv(3, CNUM, 5, 1, fused=fused), 3, 256),
+    ("conv3", lambda fused: gen_conv(CNUM, 2 * CNUM, 3, 1, fused=fused), CNUM, 128),
+    ("conv5", lambda fused: gen_conv(2 * CNUM, 4 * CNUM, 3, 1, fused=fused), 2 * CNUM, 64),
+    ("conv7_atrous", lambda fused: gen_conv(2 * CNUM, 4 * CNUM, 3, rate=2, fused=fused), 2 * CNUM, 64),
+    ("conv13_upsample_conv", lambda fused: gen_deconv(2 * CNUM, 2 * CNUM, fused=fused), 2 * CNUM, 64),
+    ("conv15_upsample_conv", lambda fused: gen_deconv(CNUM, CNUM, fused=fused), CNUM, 128),
+]
+# the TorchScript profiling executor only optimizes (and fuses) a function after it ran twice
+WARMUP = 3
+
+
+def time_layer(layer, x, iterations):
+    with torch.no_grad():
+        for _ in range(WARMUP):
+            output = layer(x)
+        t = time.time()
+        for _ in range(iterations):
+            layer(x)
+    return (time.time() - t) / iterations, output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--device', type=str, default="cpu")
+    opt = parser.parse_args()
+
+    # without LLVM the CPU fuser is not available and fused_gate runs the ops one by one
+    fusion = enable_cpu_fusion() if opt.device == "cpu" else True
+    results = []
+    for name, make_layer, cin, resolution in LAYERS:
+        unfused_layer = make_layer(False).to(opt.device).eval()
+        fused_layer = make_layer(True).to(opt.device).eval()
+        fused_layer.load_state_dict(unfused_layer.state_dict())
+        x = torch.randn(opt.batch_size, cin, resolution, resolution, device=opt.device)
+        unfused_time, unfused_output = time_layer(unfused_layer, x, opt.iterations)
+        fused_time, fused_output = time_layer(fused_layer, x, opt.iterations)
+        results.append({
+            "layer": name,
+            "unfused_ms": unfused_time * 1000,
+            "fused_ms": fused_time * 1000,
+            "speedup": unfused_time / fused_time,
+            "max_abs_difference": (fused_output - unfused_output).abs().max().item(),
+        })
+    print(json.dumps({"device": opt.device, "fusion": fusion, "results": results}, indent=4))
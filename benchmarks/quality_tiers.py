@@ -0,0 +1,71 @@
+"""Latency/quality trade-off of the quality tiers of Nodulegeneration.
+
+Runs the generator of every tier of QUALITY_TIERS on nodule crops and reports the batch
+latency, the speedup over the "full" tier and the masked L1/SSIM of the inpainted boxes
+against the original crop content and against the full tier. The crops are taken from
+--images/--nodules like quantize.py does, or from synthetic stacks (see benchmarks.end_to_end).
+Run from the repository root with python -m benchmarks.quality_tiers
+"""
+import argparse
+import json
+import tempfile
+from pathlib import Path
+
+import torch
+
+from benchmarks.end_to_end import write_dataset
+from model_submission.model.backends import QUALITY_TIERS, load_generator
+from model_submission.model.quantize import load_calibration_crops, mean_latency
+from model_submission.utils.metrics import masked_l1, masked_ssim
+from model_submission.utils.nodules import NoduleIndex
+
+
+def load_crops(images, nodules, num_crops, seed=0):
+    if images:
+        return load_calibration_crops(images, NoduleIndex.from_file(nodules), max_crops=num_crops, with_originals=True)
+    with tempfile.TemporaryDirectory() as workdir:
+        nodule_index = NoduleIndex(write_dataset(Path(workdir), 1, max(1, num_crops // 2), 2, 1, seed))
+        return load_calibration_crops(sorted(Path(workdir).glob("*.mha")), nodule_index, max_crops=num_crops,
+                                      with_originals=True)
+
+
+def tier_report(model, batches, full_outputs):
+    to_original, to_full = [], []
+    with torch.no_grad():
+        for (x, mask, original), full_output in zip(batches, full_outputs):
+            output = model(x, mask)
+            to_original.append((masked_l1(output, original, mask), masked_ssim(output, original, mask)))
+            to_full.append((masked_l1(output, full_output, mask), masked_ssim(output, full_output, mask)))
+    return {
+        "batch_latency_s": mean_latency(model, [(x, mask) for x, mask, _ in batches]),
+        "masked_l1_to_original": sum(l1 for l1, _ in to_original) / len(to_original),
+        "masked_ssim_to_original": sum(ssim for _, ssim in to_original) / len(to_original),
+        "masked_l1_to_full": sum(l1 for l1, _ in to_full) / len(to_full),
+        "masked_ssim_to_full": sum(ssim for _, ssim in to_full) / len(to_full),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=str, nargs='*', default=None, help='.mha images, defaults to synthetic ones')
+    parser.add_argument('--nodules', type=str, default=None, help='nodules.json with the boxes of --images')
+    parser.add_argument('--model_dir', type=str, default="model_submission/model")
+    parser.add_argument('--num_crops', type=int, default=32)
+    parser.add_argument('--batch_size', type=int, default=8)
+    opt = parser.parse_args()
+
+    crops = load_crops(opt.images, opt.nodules, opt.num_crops)
+    if len(crops) == 0:
+        raise ValueError("No crops found, check that the nodules match the images")
+    batches = [[torch.stack(tensors) for tensors in zip(*crops[i:i + opt.batch_size])]
+               for i in range(0, len(crops), opt.batch_size)]
+
+    full = load_generator(opt.model_dir, "cpu").eval()
+    with torch.no_grad():
+        full_outputs = [full(x, mask) for x, mask, _ in batches]
+    results = {}
+    for quality in QUALITY_TIERS:
+        model = full if quality == "full" else load_generator(opt.model_dir, "cpu", coarse_only=True).eval()
+        results[quality] = tier_report(model, batches, full_outputs)
+        results[quality]["speedup"] = results["full"]["batch_latency_s"] / results[quality]["batch_latency_s"]
+    print(json.dumps({"num_crops": len(crops), "tiers": results}, indent=4))
@@ -0,0 +1,76 @@
+"""Parity check and micro-benchmark of gen_subpixel_deconv against gen_deconv.
+
+Compares the two gen_deconv layers of BaseConvGenerator at their shapes for
+256x256 crops and the whole InferenceGenerator before and after
+convert_to_subpixel, on random weights unless --checkpoint is given. Exits with
+an error when a max abs difference exceeds --tolerance. Run from the repository
+root with python -m benchmarks.subpixel_deconv
+"""
+import argparse
+import copy
+import json
+import sys
+import time
+
+import torch
+
+from benchmarks.gated_conv import CNUM
+from model_submission.model.export import example_inputs
+from model_submission.model.inpaint_g import InferenceGenerator, load_inference_generator
+from model_submission.model.utils import convert_to_subpixel, gen_deconv, gen_subpixel_deconv
+
+# name, input channels, output channels, input resolution
+LAYERS = [
+    ("conv13_upsample_conv", 2 * CNUM, 2 * CNUM, 64),
+    ("conv15_upsample_conv", CNUM, CNUM, 128),
+]
+
+
+def time_call(fn, inputs, iterations):
+    with torch.no_grad():
+        output = fn(*inputs)
+        t = time.time()
+        for _ in range(iterations):
+            fn(*inputs)
+    return (time.time() - t) / iterations, output
+
+
+def compare(name, reference, subpixel, inputs, iterations):
+    reference_time, reference_output = time_call(reference, inputs, iterations)
+    subpixel_time, subpixel_output = time_call(subpixel, inputs, iterations)
+    return {
+        "layer": name,
+        "deconv_ms": reference_time * 1000,
+        "subpixel_ms": subpixel_time * 1000,
+        "speedup": reference_time / subpixel_time,
+        "max_abs_difference": (subpixel_output - reference_output).abs().max().item(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--checkpoint', type=str, default=None)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--tolerance', type=float, default=1e-4)
+    parser.add_argument('--device', type=str, default="cpu")
+    opt = parser.parse_args()
+
+    results = []
+    for name, cin, cout, resolution in LAYERS:
+        layer = gen_deconv(cin, cout).to(opt.device).eval()
+        x = torch.randn(opt.batch_size, cin, resolution, resolution, device=opt.device)
+        results.append(compare(name, layer, gen_subpixel_deconv.from_deconv(layer), [x], opt.iterations))
+
+    if opt.checkpoint:
+        net = load_inference_generator(opt.checkpoint)
+    else:
+        net = InferenceGenerator()
+    net = net.to(opt.device).eval()
+    subpixel_net = convert_to_subpixel(copy.deepcopy(net))
+    inputs = example_inputs(opt.batch_size, device=opt.device)
+    results.append(compare("generator", net, subpixel_net, inputs, opt.iterations))
+
+    print(json.dumps(results, indent=4))
+    if any(result["max_abs_difference"] > opt.tolerance for result in results):
+        sys.exit("gen_subpixel_deconv differs more than %.1e from gen_deconv" % opt.tolerance)
@@ -0,0 +1,47 @@
+"""Runs the nodule generation of a directory through a running server.py instead of process.py.
+
+Sends every .mha image of --input with the boxes of --input/nodules.json to the server and
+writes the results and results.json to --output, like process.py does. Only uses the standard
+library, so it starts without importing torch.
+"""
+import argparse
+import json
+from pathlib import Path
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+
+def generate(server, input_path, output_path, nodules):
+    body = json.dumps({"input": str(input_path), "output": str(output_path), "nodules": nodules}).encode()
+    request = Request(server.rstrip("/") + "/generate", data=body, headers={"Content-Type": "application/json"})
+    try:
+        with urlopen(request) as response:
+            return json.loads(response.read())
+    except HTTPError as e:
+        raise RuntimeError(f"{input_path}: {json.loads(e.read())['error']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', type=str, default="http://127.0.0.1:8642")
+    parser.add_argument('--input', type=str, default="/input/")
+    parser.add_argument('--output', type=str, default="/output/")
+    opt = parser.parse_args()
+
+    input_dir, output_dir = Path(opt.input).resolve(), Path(opt.output).resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with open(input_dir / "nodules.json") as f:
+        nodules = json.load(f)
+
+    results = []
+    for input_path in sorted(input_dir.glob("*.mha")):
+        response = generate(opt.server, input_path, output_dir / input_path.name, nodules)
+        print(f"{input_path.name} took {response['time']:.2f}s")
+        # same entries as SegmentationAlgorithm.process_case
+        results.append({
+            "outputs": [dict(type="metaio_image", filename=input_path.name)],
+            "inputs": [dict(type="metaio_image", filename=input_path.name)],
+            "error_messages": [],
+        })
+    with open(output_dir / "results.json", "w") as f:
+        json.dump(results, f)
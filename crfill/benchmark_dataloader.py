@@ -0,0 +1,66 @@
+"""Compares the DataLoader throughput of a training dataset for different --dataset_fields.
+
+python benchmark_dataloader.py --dataset_mode custom_train --train_image_dir /data/node21_data --batchSize 80 --num_workers 5
+runs --num_batches batches for every set of fields in --compare and prints the samples per second and
+the size of a collated batch as JSON. For the crop store, pass --dataset_mode crop_store --crop_store_dir,
+add --group_by_image to decode every image once per batch.
+"""
+import argparse
+import json
+import random
+import time
+
+import torch
+
+import data
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--dataset_mode', type=str, default='custom_train')
+parser.add_argument('--batchSize', type=int, default=80)
+parser.add_argument('--num_workers', type=int, default=5)
+parser.add_argument('--num_batches', type=int, default=20)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--compare', type=str, nargs='+', default=['real_image,inputs,mask', 'real_image,inputs,mask,original_image'],
+                    help='comma separated --dataset_fields to compare')
+opt, _ = parser.parse_known_args()
+parser = data.get_option_setter(opt.dataset_mode)(parser, True)
+opt = parser.parse_args()
+
+
+def batch_bytes(batch):
+    if torch.is_tensor(batch):
+        return batch.element_size() * batch.nelement()
+    if isinstance(batch, dict):
+        return sum(batch_bytes(value) for value in batch.values())
+    if isinstance(batch, (list, tuple)):
+        return sum(batch_bytes(value) for value in batch)
+    return 0
+
+
+results = []
+for fields in opt.compare:
+    opt.dataset_fields = fields.split(',')
+    random.seed(opt.seed)
+    paths_and_nodules = data.get_train_paths_and_nodules(opt)
+    dataset = data.find_dataset_using_name(opt.dataset_mode)()
+    dataset.initialize(opt, paths_and_nodules, 'train')
+    dataloader = data.create_train_dataloader(opt, dataset)
+
+    iterator = iter(dataloader)
+    # the first batch includes the start up of the workers
+    size = batch_bytes(next(iterator))
+    num_batches = 0
+    start = time.perf_counter()
+    for batch in iterator:
+        num_batches += 1
+        if num_batches == opt.num_batches:
+            break
+    elapsed = time.perf_counter() - start
+    results.append({
+        'dataset_fields': opt.dataset_fields,
+        'batches': num_batches,
+        'samples_per_s': num_batches * opt.batchSize / elapsed if num_batches else None,
+        'batch_mb': size / 2 ** 20,
+    })
+print(json.dumps({'dataset_mode': opt.dataset_mode, 'batchSize': opt.batchSize, 'num_workers': opt.num_workers,
+                  'results': results}, indent=4))
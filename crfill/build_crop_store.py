@@ -0,0 +1,19 @@
+"""Decodes the training images once into a crop store for --dataset_mode_train crop_store.
+
+python build_crop_store.py --train_image_dir /data/node21_data --crop_store_dir /data/node21_store --include_chexpert --include_mimic
+"""
+import argparse
+
+from data.crop_store import write_crop_store
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--train_image_dir', type=str, required=True,
+                    help='directory with the node21, chexpert and mimic folders and their metadata.csv')
+parser.add_argument('--crop_store_dir', type=str, required=True, help='directory to write the store to')
+parser.add_argument('--include_chexpert', action='store_true', help='Include chexpert positive-lesion dataset')
+parser.add_argument('--include_mimic', action='store_true', help='Include mimic positive-lesion dataset')
+opt = parser.parse_args()
+
+images = write_crop_store(opt.crop_store_dir, opt.train_image_dir, opt.include_chexpert, opt.include_mimic)
+print(f"wrote {len(images)} images with {sum(len(image['bboxes']) for image in images)} nodules "
+      f"to {opt.crop_store_dir}")
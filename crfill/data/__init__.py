@@ -6,6 +6,8 @@ Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses
 import importlib
 import torch.utils.data
 from data.base_dataset import BaseDataset
+from data.crop_store import CropStore
+from data.image_grouped_sampler import ImageGroupedBatchSampler, collate_image_groups
 from util.metadata_utils import get_paths_and_nodules, get_paths_negatives
 
 
@@ -55,20 +57,45 @@ def create_dataloader(opt):
     return dataloader
 
 
+def get_train_paths_and_nodules(opt):
+    # with a crop store (dataset_mode_train crop_store) the list is read from its index, not from the image folders
+    if getattr(opt, 'crop_store_dir', None) is not None:
+        return CropStore(opt.crop_store_dir).paths_and_nodules(opt.include_chexpert, opt.include_mimic,
+                                                               opt.node21_resample_count)
+    return get_paths_and_nodules(opt.train_image_dir, opt.include_chexpert,
+                                 opt.include_mimic, opt.node21_resample_count)
+
+
+def create_train_dataloader(opt, instance):
+    if getattr(opt, 'group_by_image', False):
+        # the nodules of an image in a batch are cropped from a single decode of that image
+        batch_sampler = ImageGroupedBatchSampler(instance.paths_and_nodules, opt.batchSize, opt.max_group_size)
+        return torch.utils.data.DataLoader(
+            instance,
+            batch_sampler=batch_sampler,
+            collate_fn=collate_image_groups,
+            num_workers=int(opt.num_workers)
+        )
+    return torch.utils.data.DataLoader(
+        instance,
+        batch_size=opt.batchSize,
+        shuffle=True,
+        num_workers=int(opt.num_workers),
+        drop_last=True
+    )
+
+
 def create_dataloader_trainval(opt):
     assert opt.isTrain
     # get the path to images and the nodules locations, these are already shuffled
     if opt.model == 'arrange':
-        paths_and_nodules = get_paths_and_nodules(opt.train_image_dir, opt.include_chexpert,
-                                              opt.include_mimic, opt.node21_resample_count)
+        paths_and_nodules = get_train_paths_and_nodules(opt)
     elif opt.model == 'arrangeskipconn':
-        paths_positive = get_paths_and_nodules(opt.train_image_dir, opt.include_chexpert,
-                                              opt.include_mimic, opt.node21_resample_count)
+        paths_positive = get_train_paths_and_nodules(opt)
         paths_negative = get_paths_negatives(opt.train_image_dir)
         paths_and_nodules = [paths_positive, paths_negative]
     elif opt.model == 'arrangedoubledisc':
-        paths_and_nodules = get_paths_and_nodules(opt.train_image_dir, opt.include_chexpert,
-                                              opt.include_mimic, opt.node21_resample_count)
+        paths_and_nodules = get_train_paths_and_nodules(opt)
     else:
         raise ValueError(f'Unrecognized model name: {opt.model}')
     dataset = find_dataset_using_name(opt.dataset_mode_train)
@@ -77,13 +104,7 @@ def create_dataloader_trainval(opt):
     print("dataset [%s] of size %d was created" %
           (type(instance).__name__, len(instance)))
     print(f"Num workers: {int(opt.num_workers)}. Threads available: {torch.get_num_threads()}")
-    dataloader_train = torch.utils.data.DataLoader(
-        instance,
-        batch_size=opt.batchSize,
-        shuffle=True,
-        num_workers=int(opt.num_workers),
-        drop_last=True
-    )
+    dataloader_train = create_train_dataloader(opt, instance)
     dataset = find_dataset_using_name(opt.dataset_mode_train)
     instance = dataset()
     instance.initialize(opt, paths_and_nodules, 'valid')
@@ -5,7 +5,6 @@ Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses
 
 import torch.utils.data as data
 from PIL import Image
-import torchvision.transforms as transforms
 import numpy as np
 import random
 
@@ -42,11 +41,3 @@ def get_params(opt, size):
 
     flip = random.random() > 0.5
     return {'crop_pos': (x, y), 'flip': flip}
-
-
-def basic_transform():
-    transform_list = []
-    transform_list += [transforms.ToTensor()]
-    transform_list += [transforms.Normalize((0.5,), (0.5,))]
-
-    return transforms.Compose(transform_list)
@@ -0,0 +1,98 @@
+import json
+import os
+import random
+from itertools import groupby
+from pathlib import Path
+
+import SimpleITK as sitk
+import numpy as np
+
+from util.metadata_utils import get_paths_and_nodules_helper
+
+STORE_FILE = 'images.u16'
+INDEX_FILE = 'index.json'
+# corpora in the order of get_paths_and_nodules, with the chex_or_mimic flag of their metadata.csv
+CORPORA = [('node21', False), ('chexpert', True), ('mimic', True)]
+
+
+def write_crop_store(store_dir, image_dir, include_chexpert=True, include_mimic=True):
+    """Decodes every image with nodules of the node21/chexpert/mimic folders of image_dir once and writes them
+       to store_dir, as one uint16 file of all images after each other and an index.json with the path, corpus,
+       offset (in pixels), shape, spacing and bboxes of every image."""
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    images = []
+    offset = 0
+    with open(store_dir / (STORE_FILE + '.tmp'), 'wb') as f:
+        for corpus, chex_or_mimic in CORPORA:
+            if (corpus == 'chexpert' and not include_chexpert) or (corpus == 'mimic' and not include_mimic):
+                continue
+            entries = get_paths_and_nodules_helper(os.path.join(Path(image_dir), Path(corpus)), chex_or_mimic)
+            # the entries of an image are next to each other, one per nodule
+            for path, path_entries in groupby(entries, key=lambda entry: entry[0]):
+                img = sitk.ReadImage(path, imageIO="MetaImageIO")
+                img_np = sitk.GetArrayFromImage(img)
+                if img_np.ndim != 2 or img_np.min() < 0 or img_np.max() > np.iinfo(np.uint16).max:
+                    raise ValueError(f'{path} is not a single channel image with uint16 pixel values')
+                f.write(img_np.astype(np.uint16).tobytes())
+                images.append({
+                    'path': path,
+                    'corpus': corpus,
+                    'offset': offset,
+                    'shape': list(img_np.shape),
+                    'spacing': list(img.GetSpacing()),
+                    'bboxes': [bbox for _, bbox in path_entries],
+                })
+                offset += img_np.size
+    with open(store_dir / (INDEX_FILE + '.tmp'), 'w') as f:
+        json.dump({'images': images}, f)
+    # the index is replaced last, so a store is either complete or not readable
+    os.replace(store_dir / (STORE_FILE + '.tmp'), store_dir / STORE_FILE)
+    os.replace(store_dir / (INDEX_FILE + '.tmp'), store_dir / INDEX_FILE)
+    return images
+
+
+class CropStore:
+    """Images written by write_crop_store, read as views of a memory-mapped file.
+       Slicing a crop window from an image only reads the pages of that window."""
+
+    def __init__(self, store_dir):
+        self.store_dir = Path(store_dir)
+        with open(self.store_dir / INDEX_FILE) as f:
+            self.images = json.load(f)['images']
+        self.images_by_path = {image['path']: image for image in self.images}
+        self.data = None
+
+    def __getstate__(self):
+        # every DataLoader worker maps the file itself
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    def image(self, path, return_spacing=False):
+        if path not in self.images_by_path:
+            raise FileNotFoundError(f'{path} is not in the crop store {self.store_dir}')
+        if self.data is None:
+            self.data = np.memmap(self.store_dir / STORE_FILE, dtype=np.uint16, mode='r')
+        image = self.images_by_path[path]
+        h, w = image['shape']
+        img_np = self.data[image['offset']: image['offset'] + h * w].reshape(h, w)
+        if return_spacing:
+            return img_np, tuple(image['spacing'])
+        return img_np
+
+    def paths_and_nodules(self, include_chexpert=True, include_mimic=True, resample_count_node21=0):
+        """Same list as get_paths_and_nodules, from the index instead of the metadata and image folders."""
+        corpus_lists = {corpus: [] for corpus, _ in CORPORA}
+        for image in self.images:
+            corpus_lists[image['corpus']] += [[image['path'], bbox] for bbox in image['bboxes']]
+
+        total_image_nodule_list = corpus_lists['node21'] * max(resample_count_node21, 1)
+        if include_chexpert:
+            total_image_nodule_list += corpus_lists['chexpert']
+        if include_mimic:
+            total_image_nodule_list += corpus_lists['mimic']
+
+        # shuffled like get_paths_and_nodules, so the folds are the same with the same seed
+        random.shuffle(total_image_nodule_list)
+        return total_image_nodule_list
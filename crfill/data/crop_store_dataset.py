@@ -0,0 +1,21 @@
+from data.crop_store import CropStore
+from data.custom_train_dataset import CustomTrainDataset
+
+
+class CropStoreDataset(CustomTrainDataset):
+    """CustomTrainDataset that takes its images from a crop store (see build_crop_store.py) instead of decoding
+       the .mha files, the crop window is sliced from the memory-mapped store."""
+
+    @staticmethod
+    def modify_commandline_options(parser, is_train):
+        parser = CustomTrainDataset.modify_commandline_options(parser, is_train)
+        parser.add_argument('--crop_store_dir', type=str, required=True,
+                            help='directory of the crop store written by build_crop_store.py')
+        return parser
+
+    def initialize(self, opt, path_and_nodules, mod):
+        super(CropStoreDataset, self).initialize(opt, path_and_nodules, mod)
+        self.store = CropStore(opt.crop_store_dir)
+
+    def mha_loader(self, image_path, return_spacing=False):
+        return self.store.image(image_path, return_spacing)
@@ -1,8 +1,8 @@
 import SimpleITK as sitk
 import numpy as np
 import torch
-from data.base_dataset import BaseDataset, basic_transform
-from data.custom_transformations import mask_image, crop_around_mask_bbox, normalize_cxr
+from data.base_dataset import BaseDataset
+from data.custom_transformations import mask_image, crop_around_mask_bbox, normalize_cxr, cxr_to_model_range
 
 
 class CustomTrainDataset(BaseDataset):
@@ -10,6 +10,12 @@ class CustomTrainDataset(BaseDataset):
        'chexpert' and 'mimic'. Each of these folders should contain their respective metadata.csv file. (for node21, I expect only
        the images folder found inside of cxr_imaged/processed_data)"""
 
+    # fields a sample can have, see --dataset_fields. source is a lazy handle to the full image: its path and the
+    # [x, y, w, h] crop window in it, load it with mha_loader when it is needed
+    FIELDS = ('real_image', 'inputs', 'mask', 'image_bbox', 'original_image', 'source')
+    # the fields the models read
+    DEFAULT_FIELDS = ('real_image', 'inputs', 'mask')
+
     @staticmethod
     def modify_commandline_options(parser, is_train):
         parser.add_argument('--train_image_dir', type=str, required=True,
@@ -28,12 +34,20 @@ class CustomTrainDataset(BaseDataset):
                             help='Include mimic positive-lesion dataset')
         parser.add_argument('--node21_resample_count', type=int, default=0,
                             help='How many times node21 data is resampled')
+        parser.add_argument('--dataset_fields', type=str, nargs='+', default=list(CustomTrainDataset.DEFAULT_FIELDS),
+                            choices=CustomTrainDataset.FIELDS,
+                            help='fields of every sample, the full resolution original_image is only needed for debugging')
+        parser.add_argument('--group_by_image', action='store_true',
+                            help='decode every image once per batch for all of its nodules in that batch')
+        parser.add_argument('--max_group_size', type=int, default=4,
+                            help='with --group_by_image, at most this many crops are cut from one decode of an image')
         return parser
 
     def initialize(self, opt, path_and_nodules, mod):
         self.opt = opt
         self.mod = mod
         self.paths_and_nodules = path_and_nodules
+        self.fields = set(getattr(opt, 'dataset_fields', self.DEFAULT_FIELDS))
 
         self.full_dataset_size = len(self.paths_and_nodules)
         self.fold_size = int(self.full_dataset_size / opt.num_folds)
@@ -53,8 +67,6 @@ class CustomTrainDataset(BaseDataset):
         elif self.mod == 'valid':
             self.dataset_size = 0
 
-        self.transform = basic_transform()
-
         self.rng = np.random.default_rng(seed=opt.seed)
 
     def get_true_index(self, index):
@@ -80,6 +92,10 @@ class CustomTrainDataset(BaseDataset):
 
     def __getitem__(self, index):
         # TODO make this process much faster, remove all useless checks
+        # with --group_by_image, index is a list of indices of the same image (see ImageGroupedBatchSampler),
+        # the image is decoded once for all of them and a list of samples is returned
+        if isinstance(index, (list, tuple)):
+            return self.get_group(index)
         # input image (real images)
         image_path = ''
         #index = self.get_true_index(index)
@@ -87,36 +103,46 @@ class CustomTrainDataset(BaseDataset):
             image_path = self.paths_and_nodules[index][0]
             image_mask_bbox = self.paths_and_nodules[index][1]
             full_image = self.mha_loader(image_path)
-
-
-
-            crop_size = self.opt.crop_around_mask_size
-
-            # Crop around nodule
-            cropped_image, new_mask_bbox, _ = crop_around_mask_bbox(full_image, image_mask_bbox,
-                                                                 crop_size=crop_size,
-                                                                 rng=self.rng)
-
-            #old
-            cropped_image = normalize_cxr(cropped_image)  # divide 4095
-            #new
-            #cropped_image = cropped_image / np.max(cropped_image)
-
-            cropped_masked_image, mask_array = mask_image(cropped_image, new_mask_bbox)
-            full_image = np.array(normalize_cxr(full_image), dtype='float32')
-            # params = get_params(self.opt, cropped_image.shape)
-
-            mask_tensor = torch.Tensor(mask_array)
-            image_tensor = self.transform(cropped_image)
-            masked_image_tensor = self.transform(cropped_masked_image)
-            input_dict = {
-                'original_image': torch.Tensor(full_image),
-                'image_bbox': new_mask_bbox,
-                'real_image': image_tensor.float(),
-                'inputs': masked_image_tensor.float(),
-                'mask': mask_tensor.float()
-            }
-            return input_dict
+            return self.get_sample(image_path, full_image, image_mask_bbox)
         except FileNotFoundError:
             print(f"No image found at: {image_path}")
             return self.__getitem__((index + 1) % self.__len__())
+
+    def get_group(self, indices):
+        image_path = self.paths_and_nodules[indices[0]][0]
+        try:
+            full_image = self.mha_loader(image_path)
+        except FileNotFoundError:
+            print(f"No image found at: {image_path}")
+            return [self.__getitem__((index + 1) % self.__len__()) for index in indices]
+        return [self.get_sample(image_path, full_image, self.paths_and_nodules[index][1]) for index in indices]
+
+    def get_sample(self, image_path, full_image, image_mask_bbox):
+        crop_size = self.opt.crop_around_mask_size
+
+        # Crop around nodule
+        cropped_image, new_mask_bbox, crop_bbox = crop_around_mask_bbox(full_image, image_mask_bbox,
+                                                                     crop_size=crop_size,
+                                                                     rng=self.rng)
+
+        # divide 4095 and map to [-1, 1] in float32, the mask value 1 is the same in that range
+        cropped_image = cxr_to_model_range(cropped_image)
+
+        cropped_masked_image, mask_array = mask_image(cropped_image, new_mask_bbox)
+        # params = get_params(self.opt, cropped_image.shape)
+
+        # only the fields of --dataset_fields are built, they are all collated and sent through the DataLoader
+        input_dict = {}
+        if 'real_image' in self.fields:
+            input_dict['real_image'] = torch.from_numpy(cropped_image)[None]
+        if 'inputs' in self.fields:
+            input_dict['inputs'] = torch.from_numpy(cropped_masked_image)[None]
+        if 'mask' in self.fields:
+            input_dict['mask'] = torch.Tensor(mask_array)
+        if 'image_bbox' in self.fields:
+            input_dict['image_bbox'] = new_mask_bbox
+        if 'original_image' in self.fields:
+            input_dict['original_image'] = torch.Tensor(np.array(normalize_cxr(full_image), dtype='float32'))
+        if 'source' in self.fields:
+            input_dict['source'] = {'path': image_path, 'crop_bbox': torch.tensor(crop_bbox)}
+        return input_dict
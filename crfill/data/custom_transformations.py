@@ -51,6 +51,16 @@ def normalize_cxr(image):
     return image / 4095
 
 
+def cxr_to_model_range(images, out=None):
+    # normalize_cxr + ToTensor + Normalize((0.5,), (0.5,)) of a crop or stack in one go: / 4095 * 2 - 1 in float32,
+    # into out if given. The only transform to the generator range of the datasets
+    if out is None:
+        out = np.empty(np.shape(images), dtype=np.float32)
+    np.multiply(images, 2 / 4095, out=out, dtype=np.float32)
+    np.subtract(out, 1, out=out)
+    return out
+
+
 def mask_convention_setter(mask, invert=False):
     # use this method to change the mask (if we get x,y sequence wrong for example)
     # invert should reverse back to [x,y,w,h]
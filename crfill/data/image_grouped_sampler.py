@@ -0,0 +1,56 @@
+import torch
+from torch.utils.data import Sampler
+from torch.utils.data.dataloader import default_collate
+
+
+class ImageGroupedBatchSampler(Sampler):
+    """Shuffled batches of a [path, bbox] list in which the entries of the same image are grouped, so the dataset
+       decodes that image once for all of them (see CustomTrainDataset.get_group). Batches are lists of groups,
+       collate them with collate_image_groups.
+
+       Every epoch each entry is used once, as with shuffle=True. The entries are shuffled first, the entries of an
+       image are then split in groups of at most max_group_size, which are ordered by the position of their first
+       entry, so the images are still visited in random order and nodules of resampled images spread over the epoch."""
+
+    def __init__(self, paths_and_nodules, batch_size, max_group_size=4, drop_last=True, generator=None):
+        self.paths = [path for path, _ in paths_and_nodules]
+        self.batch_size = batch_size
+        self.max_group_size = max_group_size
+        self.drop_last = drop_last
+        self.generator = generator
+
+    def groups(self):
+        order = torch.randperm(len(self.paths), generator=self.generator).tolist()
+        entries_by_path = {}
+        for position, index in enumerate(order):
+            entries_by_path.setdefault(self.paths[index], []).append((position, index))
+        groups = []
+        for entries in entries_by_path.values():
+            for i in range(0, len(entries), self.max_group_size):
+                group = entries[i: i + self.max_group_size]
+                groups.append((group[0][0], [index for _, index in group]))
+        groups.sort()
+        return [group for _, group in groups]
+
+    def __iter__(self):
+        batch, size = [], 0
+        for group in self.groups():
+            # a group that does not fit is split over two batches
+            while group:
+                batch.append(group[:self.batch_size - size])
+                size += len(batch[-1])
+                group = group[len(batch[-1]):]
+                if size == self.batch_size:
+                    yield batch
+                    batch, size = [], 0
+        if batch and not self.drop_last:
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.paths) // self.batch_size
+        return (len(self.paths) + self.batch_size - 1) // self.batch_size
+
+
+def collate_image_groups(batch):
+    return default_collate([sample for group in batch for sample in group])
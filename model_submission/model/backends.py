@@ -0,0 +1,279 @@
+import contextlib
+import functools
+import inspect
+import os
+import queue
+import warnings
+from pathlib import Path
+
+import torch
+import torch.multiprocessing as mp
+
+from model_submission.model.checkpoint import checkpoint_digest, flat_source_digest, load_flat_network
+from model_submission.model.export import (example_inputs, load_torchscript, optimize_generator,
+                                          torchscript_source_digest)
+from model_submission.model.inpaint_g import InferenceGenerator, load_inference_generator
+from model_submission.model.utils import convert_to_subpixel, enable_cpu_fusion
+from model_submission.utils.metrics import masked_l1
+
+# masked mean abs difference to the fp32 output that a precision mode may have on random crops
+PRECISION_TOLERANCES = {"fp32": 1e-4, "bf16": 1e-2}
+# "full" runs both stages of the generator, "preview" only the coarse stage1
+QUALITY_TIERS = ("full", "preview")
+
+
+class InferenceBackend:
+    """Runs the generator on a batch of normalized crops and masks of shape (b, 1, h, w).
+
+    Backends return x_stage2 as a float tensor on self.device, which is also the
+    device the inputs are expected on.
+    """
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+
+    def __call__(self, inputs, masks):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def bf16_autocast(device):
+    """Returns a function that creates a bf16 autocast context on device, raises a ValueError
+    when this torch version can not autocast to bf16 on that device."""
+    if hasattr(torch, "autocast"):
+        return functools.partial(torch.autocast, device.type, dtype=torch.bfloat16)
+    # torch.autocast is only available from torch 1.10 on, as is the dtype of torch.cuda.amp.autocast
+    if device.type == "cuda" and "dtype" in inspect.signature(torch.cuda.amp.autocast).parameters:
+        return functools.partial(torch.cuda.amp.autocast, dtype=torch.bfloat16)
+    raise ValueError(f"precision='bf16' on {device.type} requires torch >= 1.10, found torch {torch.__version__}")
+
+
+class TorchBackend(InferenceBackend):
+    """Runs an eager or TorchScript generator, optionally on channels_last inputs
+    and under bf16 autocast, which needs torch >= 1.10 (outputs are always returned as float32)."""
+
+    def __init__(self, net, device, channels_last=False, bf16=False):
+        super(TorchBackend, self).__init__(device)
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        self.autocast = bf16_autocast(self.device) if bf16 else contextlib.nullcontext
+        if self.device.type == "cpu":
+            # fuses the gates of gen_conv, CUDA fuses them by default
+            enable_cpu_fusion()
+        self.net = net.to(self.device, memory_format=self.memory_format)
+        self.net.eval()
+
+    def __call__(self, inputs, masks):
+        inputs = inputs.contiguous(memory_format=self.memory_format)
+        masks = masks.contiguous(memory_format=self.memory_format)
+        with torch.no_grad(), self.autocast():
+            return self.net(inputs, masks).float()
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+    def __init__(self, onnx_path, num_threads=0):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("The onnx backend requires onnxruntime, install it with `pip install onnxruntime`")
+        super(OnnxRuntimeBackend, self).__init__("cpu")
+        options = onnxruntime.SessionOptions()
+        # enables constant folding and the fused conv + activation kernels of the CPU provider
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(str(onnx_path), options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, inputs, masks):
+        output = self.session.run(None, {"x": inputs.cpu().numpy(), "mask": masks.cpu().numpy()})[0]
+        return torch.from_numpy(output)
+
+
+def _pool_worker(net, num_threads, requests, responses):
+    torch.set_num_threads(num_threads)
+    enable_cpu_fusion()
+    responses.put(None)  # ready
+    with torch.no_grad():
+        while True:
+            request = requests.get()
+            if request is None:
+                return
+            index, inputs, masks = request
+            try:
+                output = net(inputs, masks)
+            except Exception as e:
+                output = e  # raised again by WorkerPoolBackend
+            responses.put((index, output))
+
+
+class WorkerPoolBackend(InferenceBackend):
+    """Shards every batch over num_workers CPU processes with threads_per_worker intra-op threads each.
+
+    The parameters of the eager net are moved to shared memory once and all workers use
+    them without copies. A batch is split into one shard per worker (at most), so batches
+    should hold at least num_workers crops to keep all workers busy.
+    """
+
+    def __init__(self, net, num_workers=None, threads_per_worker=1):
+        super(WorkerPoolBackend, self).__init__("cpu")
+        if num_workers is None:
+            num_workers = max(1, (os.cpu_count() or 1) // threads_per_worker)
+        self.num_workers = num_workers
+        net = net.cpu().eval()
+        net.share_memory()
+
+        # spawn, as forking a process that already used the OpenMP thread pool can deadlock
+        context = mp.get_context("spawn")
+        self.requests = context.Queue()
+        self.responses = context.Queue()
+        self.workers = [context.Process(target=_pool_worker, args=(net, threads_per_worker, self.requests, self.responses),
+                                        daemon=True)
+                        for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+        # the workers import torch and unpickle the net before they are ready
+        for _ in self.workers:
+            self.get_response()
+
+    def get_response(self):
+        while True:
+            try:
+                return self.responses.get(timeout=1)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError("An inference worker process died")
+
+    def __call__(self, inputs, masks):
+        shards = list(zip(torch.chunk(inputs.cpu(), self.num_workers), torch.chunk(masks.cpu(), self.num_workers)))
+        for index, (shard_inputs, shard_masks) in enumerate(shards):
+            self.requests.put((index, shard_inputs, shard_masks))
+
+        # all shards are received before an error is raised, so no response is left for the next call
+        outputs = [None] * len(shards)
+        for _ in shards:
+            index, output = self.get_response()
+            outputs[index] = output
+        for output in outputs:
+            if isinstance(output, Exception):
+                raise output
+        return torch.cat(outputs)
+
+    def close(self):
+        for _ in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+
+def matches_checkpoint(artifact_path, source_digest):
+    """Whether the artifact with source_digest was converted from model1.pth next to it.
+
+    A stale artifact (model1.pth was updated since) gives a warning, without model1.pth
+    the artifact is used as is.
+    """
+    checkpoint_path = Path(artifact_path).with_name("model1.pth")
+    if not checkpoint_path.exists() or source_digest == checkpoint_digest(checkpoint_path):
+        return True
+    warnings.warn(f"{artifact_path} was not converted from {checkpoint_path}, it is ignored. "
+                  f"Export or convert it again to use it")
+    return False
+
+
+def generator_path(model_dir):
+    # model1.flat if it was converted from model1.pth (see model_submission/model/checkpoint.py), otherwise model1.pth
+    flat_path = Path(model_dir) / "model1.flat"
+    if flat_path.exists() and matches_checkpoint(flat_path, flat_source_digest(flat_path)):
+        return flat_path
+    return Path(model_dir) / "model1.pth"
+
+
+def backend_artifacts(name, model_dir, channels_last=False, precision="fp32", subpixel_deconv=False, quality="full"):
+    """The files in model_dir that load_backend reads for these settings."""
+    model_dir = Path(model_dir)
+    if name == "onnx":
+        # newer exporters store the weights next to the graph
+        return [path for path in (model_dir / "model1.onnx", model_dir / "model1.onnx.data") if path.exists()]
+    if name == "int8":
+        return [model_dir / "model1_int8.pt"]
+    traced_path = model_dir / "model1_traced.pt"
+    # the traced artifact is fp32 in the default memory format and has no subpixel_deconv or preview variant
+    if (name == "torch" and traced_path.exists() and not channels_last and precision == "fp32" and not subpixel_deconv
+            and quality == "full" and matches_checkpoint(traced_path, torchscript_source_digest(traced_path))):
+        return [traced_path]
+    return [generator_path(model_dir)]
+
+
+def load_generator(model_dir, device, coarse_only=False):
+    """The InferenceGenerator on device, from model1.flat or model1.pth (see generator_path)."""
+    path = generator_path(model_dir)
+    if path.suffix == ".flat":
+        return load_flat_network(InferenceGenerator(coarse_only), path, device)
+    return load_inference_generator(str(path), coarse_only).to(device)
+
+
+def load_backend(name, model_dir, device, channels_last=False, precision="fp32", subpixel_deconv=False,
+                 num_workers=None, threads_per_worker=1, quality="full"):
+    """Creates the backend called name from the artifacts in model_dir.
+
+    torch: model1_traced.pt if it was exported from the current model1.pth, otherwise the InferenceGenerator weights
+    of model1.flat or model1.pth in eager mode.
+    onnx: model1.onnx, see model_submission/model/export.py.
+    int8: model1_int8.pt, see model_submission/model/quantize.py.
+    pool: the eager generator on CPU, shared by num_workers processes, see WorkerPoolBackend.
+
+    channels_last and precision="bf16" are only supported by the torch backend, bf16 needs torch >= 1.10.
+    In fp32 channels_last traces and freezes the generator, which prepacks the
+    conv weights for oneDNN. bf16 autocast is not applied inside frozen graphs,
+    so in bf16 the generator always runs in eager mode. Both never use model1_traced.pt.
+    subpixel_deconv converts the gen_deconv layers of model1.pth to the equivalent
+    gen_subpixel_deconv, export with --subpixel-deconv to get a traced artifact of it.
+    quality="preview" returns the coarse stage1 output (torch and pool backends, never traced artifacts).
+    """
+    if precision not in PRECISION_TOLERANCES:
+        raise ValueError(f"Unknown precision: {precision}")
+    if quality not in QUALITY_TIERS:
+        raise ValueError(f"Unknown quality tier: {quality}")
+    if name != "torch" and (channels_last or precision != "fp32"):
+        raise ValueError(f"channels_last and bf16 are only supported by the torch backend, not {name}")
+    if name not in ("torch", "pool") and (subpixel_deconv or quality != "full"):
+        raise ValueError(f"subpixel_deconv and the preview tier are only supported by the torch and pool backends, "
+                         f"not {name}")
+    bf16 = precision == "bf16"
+    coarse_only = quality == "preview"
+
+    model_dir = Path(model_dir)
+    if name == "torch":
+        traced_path = model_dir / "model1_traced.pt"
+        if backend_artifacts(name, model_dir, channels_last, precision, subpixel_deconv, quality) == [traced_path]:
+            return TorchBackend(load_torchscript(traced_path, device), device)
+        net = load_generator(model_dir, device, coarse_only)
+        if subpixel_deconv:
+            net = convert_to_subpixel(net)
+        if channels_last and not bf16:
+            return TorchBackend(optimize_generator(net, device, channels_last=True), device, channels_last)
+        return TorchBackend(net, device, channels_last, bf16)
+    elif name == "onnx":
+        return OnnxRuntimeBackend(model_dir / "model1.onnx")
+    elif name == "pool":
+        net = load_generator(model_dir, "cpu", coarse_only)
+        if subpixel_deconv:
+            net = convert_to_subpixel(net)
+        return WorkerPoolBackend(net, num_workers, threads_per_worker)
+    elif name == "int8":
+        # quantized kernels only run on CPU
+        return TorchBackend(torch.jit.load(str(model_dir / "model1_int8.pt"), map_location="cpu"), "cpu")
+    else:
+        raise ValueError(f"Unknown inference backend: {name}")
+
+
+def check_tolerance(backend, reference, tolerance, batch_size=4, crop_size=256):
+    """Masked mean abs difference between backend and reference on random crops,
+    raises a RuntimeError when it exceeds tolerance."""
+    x, mask = example_inputs(batch_size, crop_size)
+    output = backend(x.to(backend.device), mask.to(backend.device)).cpu()
+    expected = reference(x.to(reference.device), mask.to(reference.device)).cpu()
+    difference = masked_l1(output, expected, mask)
+    if difference > tolerance:
+        raise RuntimeError(f"Backend output differs {difference:.2e} from the fp32 output, tolerance is {tolerance:.2e}")
+    return difference
@@ -0,0 +1,146 @@
+import argparse
+import hashlib
+import json
+import struct
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from model_submission.model.inpaint_g import InferenceGenerator
+from model_submission.model.utils import load_network_path
+
+# Flat checkpoint layout: MAGIC, the length of the JSON header as little endian uint64, the header
+# {"source_digest", "tensors": {name: {"dtype", "shape", "offset"}}} and the raw tensor data, every tensor starting
+# at an ALIGNMENT aligned offset (relative to the data start, which is aligned as well). source_digest is the
+# checkpoint_digest of the checkpoint the file was converted from.
+MAGIC = b"NGFLAT02"
+ALIGNMENT = 64
+FLAT_SUFFIX = ".flat"
+
+
+def checkpoint_digest(path):
+    """Digest of the checkpoint file at path, stored in the artifacts converted from it."""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def save_flat_checkpoint(state_dict, save_path, source_digest=""):
+    entries, offset = {}, 0
+    arrays = {}
+    for name, tensor in state_dict.items():
+        array = tensor.detach().cpu().contiguous().numpy()
+        entries[name] = {"dtype": array.dtype.name, "shape": list(array.shape), "offset": offset}
+        arrays[name] = array
+        offset = _aligned(offset + array.nbytes)
+    header_bytes = json.dumps({"source_digest": source_digest, "tensors": entries}).encode()
+    data_start = _aligned(len(MAGIC) + 8 + len(header_bytes))
+
+    with open(save_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + entries[name]["offset"])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+
+
+def _read_header(save_path):
+    """The header and the data start of a flat checkpoint, None for files of another (or an older) format."""
+    with open(save_path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return None, None
+        header_length, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_length))
+    return header, _aligned(len(MAGIC) + 8 + header_length)
+
+
+def flat_source_digest(save_path):
+    """The source_digest of a flat checkpoint, None when it has none."""
+    header, _ = _read_header(save_path)
+    if header is None:
+        return None
+    return header["source_digest"] or None
+
+
+def load_flat_checkpoint(save_path):
+    """Memory-maps a flat checkpoint and returns its tensors, which share memory with the mapping.
+
+    The file is mapped copy-on-write, so the tensors are writable without changing the file,
+    and pages are only read from disk when they are used.
+    """
+    header, data_start = _read_header(save_path)
+    if header is None:
+        raise ValueError(f"{save_path} is not a flat checkpoint, convert it again")
+
+    buffer = np.memmap(save_path, dtype=np.uint8, mode="c")
+    tensors = {}
+    for name, entry in header["tensors"].items():
+        dtype = np.dtype(entry["dtype"])
+        start = data_start + entry["offset"]
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        array = buffer[start: start + count * dtype.itemsize].view(dtype).reshape(entry["shape"])
+        tensors[name] = torch.from_numpy(array)
+    return tensors
+
+
+def load_flat_network(net, save_path, device="cpu", strict=True):
+    """Points the parameters and buffers of net at the tensors of a flat checkpoint.
+
+    On CPU the module uses the memory mapped data directly, on other devices every
+    tensor is copied once from the mapping to the device.
+    """
+    device = torch.device(device)
+    tensors = load_flat_checkpoint(save_path)
+    module_tensors = dict(net.named_parameters())
+    module_tensors.update(net.named_buffers())
+
+    missing = [name for name in module_tensors if name not in tensors]
+    unexpected = [name for name in tensors if name not in module_tensors]
+    if strict and (missing or unexpected):
+        raise RuntimeError(f"Error loading {save_path}: missing keys {missing}, unexpected keys {unexpected}")
+
+    with torch.no_grad():
+        for name, tensor in module_tensors.items():
+            if name not in tensors:
+                tensor.data = tensor.data.to(device)
+                continue
+            value = tensors[name]
+            if value.shape != tensor.shape:
+                raise RuntimeError(f"Error loading {save_path}: {name} has shape {tuple(value.shape)}, "
+                                   f"expected {tuple(tensor.shape)}")
+            tensor.data = value.to(device=device, dtype=tensor.dtype)
+    return net
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the generator weights of a checkpoint to a flat checkpoint")
+    parser.add_argument('--checkpoint', type=str, default="model_submission/model/model1.pth")
+    parser.add_argument('--output', type=str, default=None, help='defaults to model1.flat next to the checkpoint')
+    parser.add_argument('--prefix', type=str, default="baseg.", help='submodule whose weights are kept')
+    opt = parser.parse_args()
+
+    output = opt.output or str(Path(opt.checkpoint).with_suffix(FLAT_SUFFIX))
+    net = load_network_path(InferenceGenerator(), opt.checkpoint, strict=True, prefix=opt.prefix)
+    save_flat_checkpoint(net.state_dict(), output, checkpoint_digest(opt.checkpoint))
+
+    t = time.time()
+    load_network_path(InferenceGenerator(), opt.checkpoint, strict=True, prefix=opt.prefix)
+    pth_time = time.time() - t
+    t = time.time()
+    flat_net = load_flat_network(InferenceGenerator(), output)
+    flat_time = time.time() - t
+    flat_state_dict = flat_net.state_dict()
+    for name, tensor in net.state_dict().items():
+        if not torch.equal(tensor, flat_state_dict[name]):
+            raise RuntimeError(f"{name} differs after the conversion")
+    print(f"saved {output}, loaded in {flat_time:.3f}s instead of {pth_time:.3f}s")
@@ -0,0 +1,138 @@
+import argparse
+import os
+import sys
+import zipfile
+from pathlib import Path
+
+import torch
+
+from model_submission.model.checkpoint import checkpoint_digest
+from model_submission.model.inpaint_g import load_inference_generator
+from model_submission.model.utils import convert_to_subpixel
+
+# max abs difference to the eager generator that an exported artifact may have on random crops
+EXPORT_TOLERANCE = 1e-4
+# extra file of the TorchScript artifact with the checkpoint_digest of the checkpoint it was exported from
+SOURCE_DIGEST_FILE = "source_digest"
+
+
+def example_inputs(batch_size=1, crop_size=256, device="cpu", seed=0):
+    """Random crops in the [-1, 1] input range, with a random box cut out of each."""
+    generator = torch.Generator().manual_seed(seed)
+    x = torch.rand(batch_size, 1, crop_size, crop_size, generator=generator) * 2 - 1
+    mask = torch.zeros(batch_size, 1, crop_size, crop_size)
+    for i in range(batch_size):
+        w, h = torch.randint(8, crop_size // 2, (2,), generator=generator).tolist()
+        x0 = torch.randint(0, crop_size - w, (1,), generator=generator).item()
+        y0 = torch.randint(0, crop_size - h, (1,), generator=generator).item()
+        mask[i, :, y0:y0 + h, x0:x0 + w] = 1
+    x = x * (1 - mask) + mask
+    return x.to(device), mask.to(device)
+
+
+def export_torchscript(net, save_path, device="cpu", crop_size=256, source_digest=""):
+    """Traces the InferenceGenerator net, freezes it and saves it to save_path.
+
+    Freezing inlines the weights as constants, so the JIT can fold the gen_conv
+    convolutions and their gating, the artifact is specific to device. The
+    serialized graph is not yet passed through optimize_for_inference, as its
+    prepacked weights can not be saved, see load_torchscript. source_digest is
+    the checkpoint_digest of the checkpoint of net, see torchscript_source_digest.
+    """
+    model = net.to(device).eval()
+    inputs = example_inputs(crop_size=crop_size, device=device)
+    traced = torch.jit.trace(model, inputs)
+    traced = torch.jit.freeze(traced)
+    torch.jit.save(traced, str(save_path), _extra_files={SOURCE_DIGEST_FILE: source_digest})
+    return traced
+
+
+def torchscript_source_digest(save_path):
+    """The source_digest saved by export_torchscript, None for artifacts exported without one."""
+    # read from the archive directly (extra files are stored as <archive name>/extra/<file name>),
+    # torch.jit.load would deserialize the whole graph
+    with zipfile.ZipFile(save_path) as archive:
+        for name in archive.namelist():
+            if name.endswith("/extra/" + SOURCE_DIGEST_FILE):
+                return archive.read(name).decode() or None
+    return None
+
+
+def optimize_generator(net, device="cpu", channels_last=False, crop_size=256):
+    """In-memory trace + freeze + optimize_for_inference of the InferenceGenerator net.
+
+    On CPU this prepacks the conv weights into oneDNN blocked layouts.
+    """
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    model = net.to(device, memory_format=memory_format).eval()
+    inputs = [t.contiguous(memory_format=memory_format) for t in example_inputs(crop_size=crop_size, device=device)]
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(model, inputs))
+    if hasattr(torch.jit, "optimize_for_inference"):
+        traced = torch.jit.optimize_for_inference(traced)
+    return traced
+
+
+def load_torchscript(save_path, device="cpu"):
+    traced = torch.jit.load(str(save_path), map_location=device)
+    traced.eval()
+    if hasattr(torch.jit, "optimize_for_inference"):
+        # fuses conv/add chains and prepacks the conv weights for oneDNN on CPU
+        traced = torch.jit.optimize_for_inference(traced)
+    return traced
+
+
+def export_onnx(net, save_path, crop_size=256, opset_version=11):
+    """Exports the InferenceGenerator net with a dynamic batch size and crop size."""
+    model = net.cpu().eval()
+    inputs = example_inputs(crop_size=crop_size)
+    dynamic_axes = {name: {0: "batch", 2: "height", 3: "width"} for name in ("x", "mask", "x_stage2")}
+    torch.onnx.export(model, inputs, str(save_path), input_names=["x", "mask"], output_names=["x_stage2"],
+                      dynamic_axes=dynamic_axes, opset_version=opset_version)
+
+
+def max_abs_difference(model, reference, batch_size=4, crop_size=256, device="cpu", seed=0):
+    x, mask = example_inputs(batch_size, crop_size, device, seed)
+    with torch.no_grad():
+        return (model(x, mask) - reference(x, mask)).abs().max().item()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the submission generator to TorchScript or ONNX")
+    parser.add_argument('--checkpoint', type=str, default="model_submission/model/model1.pth")
+    parser.add_argument('--format', type=str, default="torchscript", choices=("torchscript", "onnx"))
+    parser.add_argument('--output', type=str, default=None,
+                        help='defaults to model1_traced.pt or model1.onnx next to the checkpoint')
+    parser.add_argument('--device', type=str, default="cpu", help='device the TorchScript artifact will be used on')
+    parser.add_argument('--subpixel-deconv', action='store_true', help='export with the gen_subpixel_deconv layers')
+    parser.add_argument('--tolerance', type=float, default=EXPORT_TOLERANCE,
+                        help='max abs difference to eager PyTorch, the artifact is removed when it is exceeded')
+    opt = parser.parse_args()
+
+    # imported here, backends itself depends on this module
+    from model_submission.model.backends import OnnxRuntimeBackend
+
+    checkpoint = Path(opt.checkpoint)
+    net = load_inference_generator(opt.checkpoint)
+    if opt.subpixel_deconv:
+        net = convert_to_subpixel(net)
+    if opt.format == "torchscript":
+        output = opt.output or str(checkpoint.with_name(checkpoint.stem + "_traced.pt"))
+        export_torchscript(net, output, opt.device, source_digest=checkpoint_digest(opt.checkpoint))
+        exported = load_torchscript(output, opt.device)
+    else:
+        opt.device = "cpu"
+        output = opt.output or str(checkpoint.with_suffix(".onnx"))
+        export_onnx(net, output)
+        exported = OnnxRuntimeBackend(output)
+    # parity check of the exported graph (run by TorchScript or ONNX Runtime) against eager PyTorch on random crops
+    eager = net.to(opt.device).eval()
+    difference = max_abs_difference(exported, eager, device=opt.device)
+    print(f"saved {output}, max abs difference to eager: {difference:.2e}")
+    if difference > opt.tolerance:
+        # load_backend would pick it up instead of the eager generator
+        os.remove(output)
+        if os.path.exists(output + ".data"):
+            # weights that the ONNX exporter stored next to the graph
+            os.remove(output + ".data")
+        sys.exit(f"{output} differs more than {opt.tolerance:.1e} from eager PyTorch and was removed")
@@ -2,7 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from model_submission.model.base_network import BaseNetwork
-from model_submission.model.utils import gen_conv, gen_deconv
+from model_submission.model.utils import gen_conv, gen_deconv, load_network_path
 from model_submission.model.splitcam import ReduceContextAttentionP1, ReduceContextAttentionP2
 
 
@@ -168,9 +168,16 @@ class BaseConvGenerator(BaseNetwork):
 
 
     def forward(self, x, mask):
-        xin = x
-        bsize, ch, height, width = x.shape
-        ones_x = torch.ones(bsize, 1, height, width).to(x.device)
+        x_stage1 = self.stage1(x, mask)
+        x_stage2, pm_return = self.stage2(x_stage1, x, mask)
+        if self.return_pm:
+            return x_stage1, x_stage2, pm_return
+
+        return x_stage1, x_stage2
+
+    def stage1(self, x, mask):
+        # built from x instead of its shape, so traced graphs keep a dynamic batch size and device
+        ones_x = torch.ones_like(x[:, 0:1, :, :])
         x = torch.cat([x, ones_x, ones_x*mask], 1)
 
         # two stage network
@@ -193,9 +200,10 @@ class BaseConvGenerator(BaseNetwork):
         x = self.conv16(x)
         x = self.conv17(x)
         x = torch.tanh(x)
-        x_stage1 = x
+        return x
 
-        x = x*mask + xin[:, 0:self.img_channel, :, :]*(1.-mask)
+    def stage2(self, x_stage1, xin, mask):
+        x = x_stage1*mask + xin[:, 0:self.img_channel, :, :]*(1.-mask)
         xnow = x
 
         ###
@@ -233,11 +241,32 @@ class BaseConvGenerator(BaseNetwork):
         x = self.allconv16(x)
         x = self.allconv17(x)
         x_stage2 = torch.tanh(x)
-        if self.return_pm:
-            return x_stage1, x_stage2, pm_return
+        return x_stage2, pm_return
+
+
+class InferenceGenerator(BaseConvGenerator):
+    """The part of TwostagendGenerator that runs in eval mode: baseg up to x_stage2.
+
+    The refinement branch and the contextual attention of TwostagendGenerator are
+    never built, use load_inference_generator to load the baseg weights of a
+    TwostagendGenerator checkpoint. With coarse_only, forward returns x_stage1
+    and skips stage2 (the "preview" quality tier).
+    """
+
+    def __init__(self, coarse_only=False):
+        super(InferenceGenerator, self).__init__(return_pm=False)
+        self.coarse_only = coarse_only
+
+    def forward(self, x, mask):
+        x_stage1 = self.stage1(x, mask)
+        if self.coarse_only:
+            return x_stage1
+        return self.stage2(x_stage1, x, mask)[0]
 
-        return x_stage1, x_stage2
 
+def load_inference_generator(save_path, coarse_only=False):
+    net = InferenceGenerator(coarse_only)
+    return load_network_path(net, save_path, strict=True, prefix="baseg.")
 
 if __name__ == "__main__":
     pass
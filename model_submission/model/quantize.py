@@ -0,0 +1,170 @@
+import argparse
+import copy
+import json
+import time
+from pathlib import Path
+
+import SimpleITK
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from model_submission.model.inpaint_g import load_inference_generator
+from model_submission.model.utils import gen_conv, gen_deconv
+from model_submission.utils.bbox import crop_around_mask_bbox, mask_image
+from model_submission.utils.metrics import masked_l1, masked_ssim
+from model_submission.utils.nodules import NoduleIndex
+from model_submission.utils.transforms import cxr_to_model_range
+
+
+class QuantizableGatedConv(nn.Module):
+    """gen_conv/gen_deconv with the convolution held in plain nn.Conv2d modules, so that FX
+    quantization can swap them for quantized convs.
+
+    A gated layer is split into one conv for the activation half and one for the sigmoid half
+    of the output channels. Splitting the conv output instead would dequantize it, this way
+    the activation, the sigmoid and the product all run on int8 tensors.
+    """
+
+    def __init__(self, layer):
+        super(QuantizableGatedConv, self).__init__()
+        self.upsample = isinstance(layer, gen_deconv)
+        self.gated = not (layer.out_channels == 3 or layer.activation is None)
+        halves = 2 if self.gated else 1
+        convs = [nn.Conv2d(layer.in_channels, layer.out_channels // halves, layer.kernel_size, stride=layer.stride,
+                           padding=layer.padding, dilation=layer.dilation, bias=True) for _ in range(halves)]
+        with torch.no_grad():
+            for conv, weight, bias in zip(convs, layer.weight.chunk(halves), layer.bias.chunk(halves)):
+                conv.weight.copy_(weight)
+                conv.bias.copy_(bias)
+        self.conv = convs[0]
+        if self.gated:
+            self.gate_conv = convs[1]
+        self.activation = layer.activation
+
+    def forward(self, x):
+        if self.upsample:
+            x = F.interpolate(x, scale_factor=2.0)
+        if not self.gated:
+            return self.conv(x)
+        return self.activation(self.conv(x)) * torch.sigmoid(self.gate_conv(x))
+
+
+def make_quantizable(module):
+    for name, child in module.named_children():
+        if isinstance(child, gen_conv):
+            setattr(module, name, QuantizableGatedConv(child))
+        else:
+            make_quantizable(child)
+    return module
+
+
+def load_calibration_crops(image_paths, nodule_index, crop_size=256, max_crops=None, with_originals=False):
+    """Builds (input, mask) crops exactly like process.py does, one per nodule box.
+
+    with_originals adds the normalized crop before masking, (input, mask, original).
+    """
+    crops = []
+    for image_path in image_paths:
+        stack = SimpleITK.GetArrayFromImage(SimpleITK.ReadImage(str(image_path)))
+        if len(stack.shape) == 2:
+            stack = stack[None]
+        for j in range(len(stack)):
+            for mask_bbox in nodule_index[j].tolist():
+                cropped_cxr, new_mask_bbox, _ = crop_around_mask_bbox(stack[j], mask_bbox, crop_size=crop_size)
+                cropped_cxr = cxr_to_model_range(cropped_cxr)
+                cropped_masked_cxr, cropped_mask = mask_image(cropped_cxr, new_mask_bbox)
+                crop = (torch.from_numpy(cropped_masked_cxr)[None], torch.Tensor(cropped_mask).float())
+                if with_originals:
+                    crop += (torch.from_numpy(cropped_cxr)[None],)
+                crops.append(crop)
+                if max_crops is not None and len(crops) == max_crops:
+                    return crops
+    return crops
+
+
+def batch_crops(crops, batch_size):
+    return [(torch.stack([x for x, _ in crops[i:i + batch_size]]), torch.stack([m for _, m in crops[i:i + batch_size]]))
+            for i in range(0, len(crops), batch_size)]
+
+
+def quantize_generator(net, calibration_batches, engine="fbgemm"):
+    """Static post-training int8 quantization of the InferenceGenerator net (stage 1 and stage 2)."""
+    torch.backends.quantized.engine = engine
+    model = make_quantizable(copy.deepcopy(net)).cpu().eval()
+    example_inputs = calibration_batches[0]
+    try:
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+        prepared = prepare_fx(model, get_default_qconfig_mapping(engine), example_inputs)
+    except ImportError:
+        # torch < 1.13 takes a qconfig dict and no example inputs
+        from torch.quantization import get_default_qconfig
+        from torch.quantization.quantize_fx import convert_fx, prepare_fx
+        prepared = prepare_fx(model, {"": get_default_qconfig(engine)})
+
+    with torch.no_grad():
+        for x, mask in calibration_batches:
+            prepared(x, mask)
+    return convert_fx(prepared)
+
+
+def mean_latency(model, batches, repeats=1):
+    with torch.no_grad():
+        model(*batches[0])  # warm up
+        t = time.time()
+        for _ in range(repeats):
+            for x, mask in batches:
+                model(x, mask)
+    return (time.time() - t) / (repeats * len(batches))
+
+
+def drift_report(fp32_model, int8_model, batches):
+    """Masked L1 and SSIM of the int8 outputs against the fp32 outputs, with the latency of both.
+
+    A speedup below 1 means the int8 model is slower than fp32 on this machine.
+    """
+    l1, ssim = [], []
+    with torch.no_grad():
+        for x, mask in batches:
+            reference, quantized = fp32_model(x, mask), int8_model(x, mask)
+            l1.append(masked_l1(quantized, reference, mask))
+            ssim.append(masked_ssim(quantized, reference, mask))
+    fp32_latency, int8_latency = mean_latency(fp32_model, batches), mean_latency(int8_model, batches)
+    return {
+        "masked_l1": sum(l1) / len(l1),
+        "masked_ssim": sum(ssim) / len(ssim),
+        "fp32_batch_latency_s": fp32_latency,
+        "int8_batch_latency_s": int8_latency,
+        "speedup": fp32_latency / int8_latency,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Static int8 quantization of the submission generator")
+    parser.add_argument('--images', type=str, nargs='+', required=True, help='.mha images to take calibration crops from')
+    parser.add_argument('--nodules', type=str, required=True, help='nodules.json with the boxes of the images')
+    parser.add_argument('--checkpoint', type=str, default="model_submission/model/model1.pth")
+    parser.add_argument('--output', type=str, default=None, help='defaults to model1_int8.pt next to the checkpoint')
+    parser.add_argument('--num_crops', type=int, default=64, help='maximum number of calibration crops')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--engine', type=str, default="fbgemm", choices=("fbgemm", "qnnpack"),
+                        help='fbgemm for x86, qnnpack for ARM')
+    opt = parser.parse_args()
+
+    checkpoint = Path(opt.checkpoint)
+    output = opt.output or str(checkpoint.with_name(checkpoint.stem + "_int8.pt"))
+    net = load_inference_generator(opt.checkpoint).cpu().eval()
+    crops = load_calibration_crops(opt.images, NoduleIndex.from_file(opt.nodules), max_crops=opt.num_crops)
+    if len(crops) == 0:
+        raise ValueError("No calibration crops found, check that the nodules match the images")
+    batches = batch_crops(crops, opt.batch_size)
+
+    quantized = quantize_generator(net, batches, opt.engine)
+    scripted = torch.jit.script(quantized)
+    torch.jit.save(scripted, output)
+    print(f"saved {output}")
+    report = drift_report(net, scripted, batches)
+    print(json.dumps(report, indent=4))
+    if report["speedup"] < 1:
+        print(f"int8 is {1 / report['speedup']:.2f}x slower than fp32 on this machine, keep the fp32 backend here")
@@ -73,6 +73,17 @@ def mask_image(image: np.ndarray, mask_bbox, mask_value=1, randomized_mask=False
     return mask_image, mask_array
 
 
+def mask_image_bboxes(image: np.ndarray, mask_bboxes, mask_value=1):
+    """same as mask_image, but all mask_bboxes are cut out into a single mask of the dtype of image"""
+    mask_image = image.copy()
+    mask_array = np.zeros((1, *image.shape), dtype=image.dtype)
+    for mask_bbox in mask_bboxes:
+        [x, y, w, h] = mask_convention_setter(mask_bbox, invert=True)  # makes sure bbox is [x,y,w,h]
+        mask_image[y:y+h, x:x+w] = mask_value
+        mask_array[:, y:y+h, x:x+w] = mask_value
+    return mask_image, mask_array
+
+
 def mask_convention_setter(mask, invert=False):
     # use this method to change the mask (if we get x,y sequence wrong for example)
     # invert should reverse back to [x,y,w,h]
@@ -82,15 +93,46 @@ def mask_convention_setter(mask, invert=False):
         return mask
 
 
-
-def crop_around_mask_bbox(image: np.ndarray, mask_bbox, crop_size=256, rng=None, return_new_mask_bbox=True):
-    """create random bbox of crop_size**2 that includes mask region and stays within image"""
-    if len(image.shape) != 2:
-        raise ValueError('Image to be cropped is not of shape (x,y) -- input only single channel image')
-
-    # mask_bbox = mask_convention_setter(mask_bbox, invert=True)  # this guarantees the mask is [x,y,w,h]
-
-    im_max_x, im_max_y = image.shape
+def create_random_bboxes(number_of_bboxes, max_x=1024, max_y=1024, rng=None):
+    # same boxes as crfill/data/custom_transformations.py for the same rng, checked by benchmarks/end_to_end.py
+    if rng is None:
+        rng = np.random.default_rng()
+    bbox_list = []
+    for i in range(number_of_bboxes):
+        # distributions that match closely what is found in the data
+        l_or_r = rng.random()  # x has this left and right factor because it occurs in lungs, not in between lungs
+        if l_or_r > 0.5:  # right lung
+            x = min(930, max(rng.normal(725, 80), 530))
+        else:  # left lung
+            x = max(20, min(rng.normal(225, 80), 450))
+
+        y = (rng.beta(2, 2) + (1 / 7)) * 700  # is bounded [100, 800]
+        w = min(rng.gamma(8, 7.5), max_x - x, 230)  # 230 is the max of the simulated_metadata, which we will have to predict on
+        h = min(rng.gamma(7, 8.4), max_y - y, 230)
+        bbox_list.append([int(x), int(y), int(w), int(h)])
+    return bbox_list
+
+
+def adaptive_crop_size(mask_bbox, margin, max_crop_size=256, multiple=4):
+    """smallest crop size that is a multiple of `multiple` and fits mask_bbox plus margin pixels on every side,
+    capped at max_crop_size"""
+    _, _, w, h = mask_bbox
+    crop_size = -(-(max(w, h) + 2 * margin) // multiple) * multiple
+    return int(min(crop_size, max_crop_size))
+
+
+def pad_bbox(mask_bbox, margin, image_shape):
+    """grows mask_bbox by margin pixels on every side, clipped to the image"""
+    x, y, w, h = mask_bbox
+    x_min, y_min = max(x - margin, 0), max(y - margin, 0)
+    x_max, y_max = min(x + w + margin, image_shape[0]), min(y + h + margin, image_shape[1])
+    return [x_min, y_min, x_max - x_min, y_max - y_min]
+
+
+def crop_window(image_shape, mask_bbox, crop_size=256, rng=None):
+    """random [crop_x, crop_y, crop_size, crop_size] window that includes the mask region and stays within the image,
+    as used by crop_around_mask_bbox"""
+    im_max_x, im_max_y = image_shape
     mask_x, mask_y, mask_w, mask_h = mask_bbox
     if rng is None:
         rng = np.random.default_rng(seed=0)
@@ -110,14 +152,38 @@ def crop_around_mask_bbox(image: np.ndarray, mask_bbox, crop_size=256, rng=None,
     else:
         crop_x = rng.integers(crop_min_x, crop_max_x)
 
+    assert crop_x + crop_size <= im_max_x, f"Crop_x is {crop_x}, such that we find max x of {crop_x + crop_size}, bbox: {mask_bbox}"
+    assert crop_y + crop_size <= im_max_y, f"Crop_y is {crop_y}, such that we find max x of {crop_y + crop_size}"
+    return [int(crop_x), int(crop_y), crop_size, crop_size]
+
+
+def crop_around_mask_bbox(image: np.ndarray, mask_bbox, crop_size=256, rng=None, return_new_mask_bbox=True):
+    """create random bbox of crop_size**2 that includes mask region and stays within image"""
+    if len(image.shape) != 2:
+        raise ValueError('Image to be cropped is not of shape (x,y) -- input only single channel image')
+
+    # mask_bbox = mask_convention_setter(mask_bbox, invert=True)  # this guarantees the mask is [x,y,w,h]
+
+    mask_x, mask_y, mask_w, mask_h = mask_bbox
+    crop_x, crop_y, _, _ = crop_window(image.shape, mask_bbox, crop_size, rng)
+
     cropped_image = crop_to_bbox(image, [crop_y, crop_x, crop_size, crop_size])
     new_mask = [mask_x - crop_x, mask_y - crop_y, mask_w, mask_h]
     new_mask = mask_convention_setter(new_mask)
 
-    assert crop_x + crop_size <= im_max_x, f"Crop_x is {crop_x}, such that we find max x of {crop_x + crop_size}, bbox: {mask_bbox}"
-    assert crop_y + crop_size <= im_max_y, f"Crop_y is {crop_y}, such that we find max x of {crop_y + crop_size}"
-
     if return_new_mask_bbox:
         return cropped_image, new_mask, [crop_x, crop_y, crop_size, crop_size]
     else:
         return cropped_image
+
+
+def box_masks(boxes, num_crops, crop_size):
+    """(num_crops, 1, crop_size, crop_size) masks that are one inside the boxes, built on the device of boxes.
+    boxes is an integer tensor of shape (n, 5) holding [crop index, x, y, w, h] relative to the crop."""
+    offsets = torch.arange(crop_size, device=boxes.device)
+    k, x, y, w, h = boxes.unbind(1)
+    inside_x = (offsets >= x[:, None]) & (offsets < (x + w)[:, None])
+    inside_y = (offsets >= y[:, None]) & (offsets < (y + h)[:, None])
+    masks = torch.zeros(num_crops, crop_size, crop_size, device=boxes.device)
+    masks.index_add_(0, k, (inside_y[:, :, None] & inside_x[:, None, :]).float())
+    return masks.clamp_(max=1)[:, None]
@@ -0,0 +1,99 @@
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+
+def model_digest(paths, **config):
+    """Digest of the model files at paths (the ones the backend loads, see backend_artifacts) and the backend config."""
+    digest = hashlib.blake2b(digest_size=20)
+    for path in map(Path, paths):
+        digest.update(path.name.encode())
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    digest.update(repr(sorted(config.items())).encode())
+    return digest.hexdigest()
+
+
+class CropCache:
+    """On-disk cache of composed crops, keyed by the input crop, its mask and the model digest.
+
+    Entries are .npy files below directory, the least recently used ones (by modification time,
+    which is updated on every hit) are removed once the cache grows beyond max_bytes. Entries are
+    written atomically, so several processes can share a directory.
+    """
+
+    # fraction of max_bytes that is left after an eviction, so not every put has to evict
+    LOW_WATER = 0.9
+
+    def __init__(self, directory, max_bytes, model_digest):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.model_digest = model_digest
+        self.size = sum(path.stat().st_size for path in self.entries())
+        self.hits = 0
+        self.misses = 0
+
+    def entries(self):
+        return self.directory.glob("*/*.npy")
+
+    def key(self, crop, mask):
+        digest = hashlib.blake2b(self.model_digest.encode(), digest_size=20)
+        for array in (crop, mask):
+            array = np.ascontiguousarray(array)
+            digest.update(f"{array.dtype.str}{array.shape}".encode())
+            digest.update(array.data)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return self.directory / key[:2] / f"{key}.npy"
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            composed = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            # missing, or removed or truncated by another process
+            self.misses += 1
+            return None
+        self.hits += 1
+        return composed
+
+    def put(self, key, composed):
+        path = self.path(key)
+        path.parent.mkdir(exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=path.parent, suffix=".tmp", delete=False) as f:
+            np.save(f, composed)
+        try:
+            # an existing entry of key is replaced
+            self.size -= path.stat().st_size
+        except OSError:
+            pass
+        os.replace(f.name, path)
+        self.size += path.stat().st_size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        for path in self.entries():
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= self.max_bytes * self.LOW_WATER:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            self.size -= size
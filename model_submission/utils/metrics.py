@@ -0,0 +1,30 @@
+import torch
+import torch.nn.functional as F
+
+
+def gaussian_window(size=11, sigma=1.5, device="cpu"):
+    coords = torch.arange(size, dtype=torch.float32, device=device) - size // 2
+    g = torch.exp(-coords ** 2 / (2 * sigma ** 2))
+    g = g / g.sum()
+    return (g[:, None] * g[None, :])[None, None]
+
+
+def ssim_map(a, b, data_range=2.0, window_size=11):
+    """Per-pixel SSIM of two (b, 1, h, w) tensors, data_range=2 matches crops normalized to [-1, 1]."""
+    window = gaussian_window(window_size, device=a.device)
+    pad = window_size // 2
+    mu_a = F.conv2d(a, window, padding=pad)
+    mu_b = F.conv2d(b, window, padding=pad)
+    var_a = F.conv2d(a * a, window, padding=pad) - mu_a ** 2
+    var_b = F.conv2d(b * b, window, padding=pad) - mu_b ** 2
+    cov = F.conv2d(a * b, window, padding=pad) - mu_a * mu_b
+    c1, c2 = (0.01 * data_range) ** 2, (0.03 * data_range) ** 2
+    return ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+
+
+def masked_l1(a, b, mask):
+    return ((a - b).abs() * mask).sum().item() / max(mask.sum().item(), 1)
+
+
+def masked_ssim(a, b, mask, data_range=2.0):
+    return (ssim_map(a, b, data_range) * mask).sum().item() / max(mask.sum().item(), 1)
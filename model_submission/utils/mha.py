@@ -0,0 +1,87 @@
+import zlib
+
+import numpy as np
+
+METAIO_ELEMENT_TYPES = {
+    np.dtype(np.uint8): "MET_UCHAR",
+    np.dtype(np.int16): "MET_SHORT",
+    np.dtype(np.uint16): "MET_USHORT",
+    np.dtype(np.float32): "MET_FLOAT",
+    np.dtype(np.float64): "MET_DOUBLE",
+}
+# room for the compressed size in the header, which is only known once all slices are written
+SIZE_FIELD_WIDTH = 20
+
+
+class MhaSliceWriter:
+    """Writes a (slices, height, width) stack to an .mha file one slice at a time.
+
+    The file is the same as SimpleITK.WriteImage(SimpleITK.GetImageFromArray(stack), path, True)
+    writes (default spacing, origin and direction, zlib compressed), but only the current
+    slice has to be in memory.
+
+    with MhaSliceWriter(path, stack_shape, np.float64) as writer:
+        for image in slices:
+            writer.write(image)
+    """
+
+    def __init__(self, path, shape, dtype, compress=True):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.compress = compress
+        self.slices_written = 0
+        self.compressed_size = 0
+
+    def header(self):
+        lines = [
+            "ObjectType = Image",
+            "NDims = 3",
+            "BinaryData = True",
+            "BinaryDataByteOrderMSB = False",
+            f"CompressedData = {self.compress}",
+        ]
+        if self.compress:
+            lines.append(f"CompressedDataSize = {self.compressed_size:<{SIZE_FIELD_WIDTH}d}")
+        lines += [
+            "TransformMatrix = 1 0 0 0 1 0 0 0 1",
+            "Offset = 0 0 0",
+            "CenterOfRotation = 0 0 0",
+            "AnatomicalOrientation = RAI",
+            "ElementSpacing = 1 1 1",
+            "DimSize = %d %d %d" % (self.shape[2], self.shape[1], self.shape[0]),
+            f"ElementType = {METAIO_ELEMENT_TYPES[self.dtype]}",
+            "ElementDataFile = LOCAL",
+        ]
+        return ("\n".join(lines) + "\n").encode()
+
+    def __enter__(self):
+        self.file = open(self.path, "wb")
+        self.file.write(self.header())
+        self.compressor = zlib.compressobj() if self.compress else None
+        return self
+
+    def write(self, image):
+        if image.shape != self.shape[1:]:
+            raise ValueError(f"Expected a slice of shape {self.shape[1:]}, got {image.shape}")
+        data = np.ascontiguousarray(image, dtype=self.dtype.newbyteorder("<")).tobytes()
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+            self.compressed_size += len(data)
+        self.file.write(data)
+        self.slices_written += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                if self.slices_written != self.shape[0]:
+                    raise ValueError(f"Wrote {self.slices_written} of {self.shape[0]} slices to {self.path}")
+                if self.compressor is not None:
+                    data = self.compressor.flush()
+                    self.compressed_size += len(data)
+                    self.file.write(data)
+                    # the header has the same length with the final size, as the field is padded
+                    self.file.seek(0)
+                    self.file.write(self.header())
+        finally:
+            self.file.close()
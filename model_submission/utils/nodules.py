@@ -0,0 +1,69 @@
+import json
+
+import numpy as np
+
+
+class NoduleIndex:
+    """Boxes of a nodules.json file grouped per slice.
+
+    The corner lists are parsed once into integer arrays of shape (n, 4) holding
+    [x, y, w, h] for every box of a slice, which is the mask_bbox convention used
+    by crop_around_mask_bbox and mask_image.
+    """
+
+    def __init__(self, data):
+        self.boxes = {}
+        self.num_boxes = len(data['boxes'])
+        if self.num_boxes == 0:
+            return
+
+        corners = np.asarray([nodule['corners'] for nodule in data['boxes']], dtype=np.float64)
+        # corners[:, 0] holds (x_max, y_max, slice), corners[:, 2] holds (x_min, y_min, slice)
+        min_xy = corners[:, 2, :2].astype(np.int64)
+        max_xy = corners[:, 0, :2].astype(np.int64)
+        mask_bboxes = np.concatenate([min_xy, max_xy - min_xy], axis=1)
+
+        slices = corners[:, 0, 2].astype(np.int64)
+        order = np.argsort(slices, kind='stable')  # keeps the file order within a slice
+        slice_ids, starts = np.unique(slices[order], return_index=True)
+        for j, idx in zip(slice_ids, np.split(order, starts[1:])):
+            self.boxes[int(j)] = mask_bboxes[idx]
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def __getitem__(self, j):
+        return self.boxes.get(j, np.zeros((0, 4), dtype=np.int64))
+
+    def __len__(self):
+        return self.num_boxes
+
+    def slices(self):
+        return sorted(self.boxes)
+
+
+def plan_crops(mask_bboxes, crop_size=256):
+    """Groups the boxes of one slice into crops, so that one forward covers several nodules.
+
+    Boxes are assigned greedily in order to the first group whose union with the box
+    still fits in a crop_size window. Returns a list of (union_bbox, member_bboxes),
+    with all boxes in [x, y, w, h] convention.
+    """
+    groups = []
+    for mask_bbox in mask_bboxes:
+        x, y, w, h = mask_bbox
+        for group in groups:
+            x_min, y_min, x_max, y_max = group[0]
+            x_min, y_min = min(x_min, x), min(y_min, y)
+            x_max, y_max = max(x_max, x + w), max(y_max, y + h)
+            if x_max - x_min <= crop_size and y_max - y_min <= crop_size:
+                group[0] = [x_min, y_min, x_max, y_max]
+                group[1].append(mask_bbox)
+                break
+        else:
+            groups.append([[x, y, x + w, y + h], [mask_bbox]])
+
+    return [([x_min, y_min, x_max - x_min, y_max - y_min], members)
+            for (x_min, y_min, x_max, y_max), members in groups]
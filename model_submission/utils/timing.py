@@ -0,0 +1,138 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class StageTimer:
+    """Times the stages of the inference pipeline per image and emits one record per image to its sinks.
+
+    with timer.image(key):           # stages timed by this thread are attributed to image key
+        with timer.stage("decode"):
+            ...
+    timer.finish(key)                # emits {"image": key, "wall_s": ..., "busy_s": ..., "stages": {...}}
+
+    The time of a stage is summed over all its calls for an image. Stages of one image may be timed
+    by several threads (see Nodulegeneration.process_cases), wall_s runs from the start of its first
+    stage to finish. With synchronize (e.g. torch.cuda.synchronize), pending device work is waited
+    for around every stage, so asynchronous kernels are attributed to the stage that launched them.
+    """
+
+    def __init__(self, sinks=(), synchronize=None):
+        self.sinks = list(sinks)
+        self.synchronize = synchronize
+        self.records = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextmanager
+    def image(self, key):
+        previous = getattr(self.local, "key", None)
+        self.local.key = key
+        try:
+            yield
+        finally:
+            self.local.key = previous
+
+    @contextmanager
+    def stage(self, name):
+        if self.synchronize is not None:
+            self.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.synchronize is not None:
+                self.synchronize()
+            elapsed = time.perf_counter() - start
+            key = getattr(self.local, "key", None)
+            with self.lock:
+                record = self.records.setdefault(key, {"start": start, "stages": {}})
+                record["stages"][name] = record["stages"].get(name, 0.0) + elapsed
+
+    def finish(self, key=None):
+        with self.lock:
+            record = self.records.pop(key, {"start": time.perf_counter(), "stages": {}})
+        record = {
+            "image": key,
+            "wall_s": time.perf_counter() - record["start"],
+            "busy_s": sum(record["stages"].values()),
+            "stages": record["stages"],
+        }
+        for sink in self.sinks:
+            sink.emit(record)
+        return record
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+class PrintSink:
+    def emit(self, record):
+        stages = ", ".join("%s %.3f" % item for item in record["stages"].items())
+        print("time for image %s: %.3fs (%s)" % (record["image"], record["wall_s"], stages))
+
+    def close(self):
+        pass
+
+
+class JsonLinesSink:
+    """Writes every record as a line of JSON to path."""
+
+    def __init__(self, path):
+        self.file = open(path, "a")
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class HistogramSink:
+    """Aggregates the records into per-stage statistics and log-spaced histograms.
+
+    summary() returns them, on close they are written to path as JSON if a path is given.
+    """
+
+    # bucket edges in seconds, 4 per decade from 10us to 1000s
+    EDGES = np.logspace(-5, 3, 33)
+
+    def __init__(self, path=None):
+        self.path = path
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        with self.lock:
+            for name, value in record["stages"].items():
+                self.values.setdefault(name, []).append(value)
+            self.values.setdefault("wall", []).append(record["wall_s"])
+
+    def summary(self):
+        with self.lock:
+            values = {name: np.asarray(stage_values) for name, stage_values in self.values.items()}
+        summary = {}
+        for name, stage_values in values.items():
+            counts, _ = np.histogram(stage_values.clip(self.EDGES[0], self.EDGES[-1]), bins=self.EDGES)
+            summary[name] = {
+                "count": len(stage_values),
+                "total_s": float(stage_values.sum()),
+                "mean_s": float(stage_values.mean()),
+                "p50_s": float(np.percentile(stage_values, 50)),
+                "p90_s": float(np.percentile(stage_values, 90)),
+                "p99_s": float(np.percentile(stage_values, 99)),
+                "histogram": {"edges_s": self.EDGES.tolist(), "counts": counts.tolist()},
+            }
+        return summary
+
+    def close(self):
+        if self.path is not None:
+            with open(self.path, "w") as f:
+                json.dump(self.summary(), f, indent=4)
@@ -1,13 +1,18 @@
-import torchvision.transforms as transforms
+import numpy as np
 
 
-def basic_transform():
-    transform_list = []
-    transform_list += [transforms.ToTensor()]
-    transform_list += [transforms.Normalize((0.5,), (0.5,))]
+def normalize_cxr(image, out=None):
+    # with out, the result is written into that preallocated array (e.g. a float32 one)
+    return np.divide(image, 4095, out=out)
 
-    return transforms.Compose(transform_list)
 
-
-def normalize_cxr(image):
-    return image / 4095
+def cxr_to_model_range(images, out=None):
+    """Maps CXR pixels (a crop or a stack of crops, of any integer or float dtype) to the [-1, 1] float32 input
+    range of the generator, the same as normalize_cxr followed by ToTensor and Normalize((0.5,), (0.5,)), but
+    computed in float32 in place in out (allocated if not given), so without the float64 intermediates and tensor
+    conversions. It is the only transform to the generator range, for the crops of process.py and quantize.py."""
+    if out is None:
+        out = np.empty(np.shape(images), dtype=np.float32)
+    np.multiply(images, 2 / 4095, out=out, dtype=np.float32)
+    np.subtract(out, 1, out=out)
+    return out
@@ -8,13 +8,19 @@ from evalutils.validators import (
     UniqueImagesValidator,
 )
 import json
+from collections import deque
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import time
 
-from model_submission.model.inpaint_g import TwostagendGenerator
-from model_submission.model.utils import load_network_path
-from model_submission.utils.bbox import crop_around_mask_bbox, mask_image
-from model_submission.utils.transforms import basic_transform, normalize_cxr
+from model_submission.model.backends import PRECISION_TOLERANCES, backend_artifacts, check_tolerance, load_backend
+from model_submission.utils.bbox import (adaptive_crop_size, box_masks, crop_to_bbox, crop_window, mask_image_bboxes,
+                                         pad_bbox)
+from model_submission.utils.cache import CropCache, model_digest
+from model_submission.utils.mha import METAIO_ELEMENT_TYPES, MhaSliceWriter
+from model_submission.utils.nodules import NoduleIndex, plan_crops
+from model_submission.utils.timing import PrintSink, StageTimer
+from model_submission.utils.transforms import cxr_to_model_range, normalize_cxr
 
 
 # This parameter adapts the paths between local execution and execution in docker. You can use this flag to switch between these two modes.
@@ -23,7 +29,16 @@ execute_in_docker = True
 
 
 class Nodulegeneration(SegmentationAlgorithm):
-    def __init__(self):
+    def __init__(self, batch_size=16, coalesce_crops=False, pipeline_depth=0, num_readers=2, backend="torch",
+                 channels_last=False, precision="fp32", subpixel_deconv=False, crop_margin=None,
+                 nodules_path="nodules.json", output_dtype="float32", stream_output=False, input_path=None,
+                 output_path=None, timer=None, num_workers=None, threads_per_worker=1, cache_dir=None,
+                 cache_max_bytes=2 ** 30, quality="full", tensor_pipeline=False, check_precision=None):
+        # input_path and output_path default to the docker or local paths, see execute_in_docker
+        if input_path is None:
+            input_path = Path("/input/") if execute_in_docker else Path("./test/")
+        if output_path is None:
+            output_path = Path("/output/") if execute_in_docker else Path("./output/")
         super().__init__(
             validators=dict(
                 input_image=(
@@ -31,77 +46,402 @@ class Nodulegeneration(SegmentationAlgorithm):
                     UniquePathIndicesValidator(),
                 )
             ),
-            input_path = Path("/input/") if execute_in_docker else Path("./test/"),
-            output_path = Path("/output/") if execute_in_docker else Path("./output/"),
-            output_file = Path("/output/results.json") if execute_in_docker else Path("./output/results.json")
+            input_path = Path(input_path),
+            output_path = Path(output_path),
+            output_file = Path(output_path) / "results.json"
 
         )
 
-        # load nodules.json for location
-        with open("/input/nodules.json" if execute_in_docker else "test/nodules.json") as f:
-            self.data = json.load(f)
+        # load nodules.json for location, with nodules_path=None (see server.py) the boxes are passed to predict
+        self.data = {"boxes": []}
+        if nodules_path is not None:
+            with open(self._input_path / nodules_path) as f:
+                self.data = json.load(f)
+        self.nodule_index = NoduleIndex(self.data)
 
         self.crop_size = 256
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # with a crop_margin, every crop is the smallest window (a multiple of 4, at most crop_size) that covers
+        # its boxes plus crop_margin pixels of context, crops of the same size are batched together
+        self.crop_margin = crop_margin
+        # number of nodule crops that are forwarded through the generator at once
+        self.batch_size = batch_size
+        # boxes of a slice that fit in one crop together are inpainted with a single forward
+        self.coalesce_crops = coalesce_crops
+        # with pipeline_depth > 0 up to that many images are read ahead by num_readers threads and their crops
+        # are cut up to that many batches ahead, while a writer thread stores the results
+        self.pipeline_depth = pipeline_depth
+        self.num_readers = num_readers
+        # the output is composed in place in a single array of output_dtype (in float32 for integer output dtypes,
+        # which are rounded when they are written), with stream_output it is composed and written one slice at
+        # a time, so only the input image and one output slice are in memory
+        self.output_dtype = np.dtype(output_dtype)
+        if self.output_dtype not in METAIO_ELEMENT_TYPES:
+            raise ValueError(f"Unsupported output_dtype: {output_dtype}, use one of "
+                             f"{', '.join(dtype.name for dtype in METAIO_ELEMENT_TYPES)}")
+        self.compose_dtype = self.output_dtype if self.output_dtype.kind == "f" else np.dtype(np.float32)
+        self.stream_output = stream_output
+        # with tensor_pipeline the stack is uploaded to the device once, crops, masks and compositing are done there
+        # and only the composed stack comes back, instead of moving every crop, mask and result separately
+        self.tensor_pipeline = tensor_pipeline
+        if tensor_pipeline and (pipeline_depth > 0 or cache_dir is not None):
+            raise ValueError("tensor_pipeline can not be combined with pipeline_depth or cache_dir, "
+                             "which work on crops on the host")
 
-        self.net1 = TwostagendGenerator()
-        model_save_path1 = "model_submission/model/model1.pth"
-        self.net1 = load_network_path(self.net1, model_save_path1, strict=True)
-        self.net1.to(self.device)
+        # "torch" runs model1.pth (or its TorchScript export), "onnx" runs model1.onnx with ONNX Runtime on CPU,
+        # "int8" the quantized model1_int8.pt on CPU and "pool" shards every batch over num_workers CPU processes
+        # with threads_per_worker threads each
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # quality="preview" only runs the coarse stage of the generator, for drafts at about half of the compute
+        # channels_last and precision="bf16" change the memory layout and precision of the torch backend,
+        # subpixel_deconv runs the x2 upsampling convs of the decoder at the input resolution. With check_precision
+        # they are checked against the fp32 output once at start up, which loads a second (reference) generator.
+        # By default only a reduced precision is checked
+        self.backend = load_backend(backend, "model_submission/model", device, channels_last, precision,
+                                    subpixel_deconv, num_workers, threads_per_worker, quality)
+        if check_precision is None:
+            check_precision = precision != "fp32"
+        if check_precision and (channels_last or precision != "fp32" or subpixel_deconv):
+            reference = load_backend("torch", "model_submission/model", device, quality=quality)
+            difference = check_tolerance(self.backend, reference, PRECISION_TOLERANCES[precision])
+            print(f"{precision} (channels_last={channels_last}, subpixel_deconv={subpixel_deconv}) "
+                  f"differs {difference:.2e} from fp32")
+        self.device = self.backend.device
 
-        self.net1.eval()
+        # the stages of every image are timed by timer (see model_submission/utils/timing.py),
+        # by default a line with the stage times is printed per image
+        if timer is None:
+            timer = StageTimer([PrintSink()], torch.cuda.synchronize if self.device.type == "cuda" else None)
+        self.timer = timer
 
-        self.transform = basic_transform()
+        # composed crops are cached in cache_dir, keyed by the input crop, its mask and the model artifacts and settings
+        self.cache = None
+        if cache_dir is not None:
+            artifacts = backend_artifacts(backend, "model_submission/model", channels_last, precision, subpixel_deconv,
+                                          quality)
+            digest = model_digest(artifacts, backend=backend, channels_last=channels_last,
+                                  precision=precision, subpixel_deconv=subpixel_deconv, quality=quality)
+            self.cache = CropCache(cache_dir, cache_max_bytes, digest)
 
-    def generate_composed_image(self, original_image, masked_image, mask):
-        mask_tensor = torch.Tensor(mask)
-        original_tensor = self.transform(original_image)
-        input_tensor = self.transform(masked_image)
-
-        mask_tensor = torch.unsqueeze(mask_tensor, 0).float().to(self.device)
-        input_tensor = torch.unsqueeze(input_tensor, 0).float().to(self.device)
-        original_tensor = torch.unsqueeze(original_tensor, 0).float().to(self.device)
-        with torch.no_grad():
-            output1 = self.net1(input_tensor, mask_tensor)
-
-        composed_output = output1[1] 
-        composed_image = composed_output * mask_tensor + original_tensor * (1 - mask_tensor)
-        composed_image_np = composed_image.cpu().numpy().reshape((self.crop_size, self.crop_size))
+    def generate_composed_images(self, original_images, masked_images, masks):
+        if self.cache is None:
+            return self.forward_composed_images(original_images, masked_images, masks)
+
+        with self.timer.stage("cache_lookup"):
+            keys = [self.cache.key(image, mask) for image, mask in zip(original_images, masks)]
+            composed_images = [self.cache.get(key) for key in keys]
+        misses = [i for i, composed_image in enumerate(composed_images) if composed_image is None]
+        if misses:
+            computed = self.forward_composed_images([original_images[i] for i in misses],
+                                                    [masked_images[i] for i in misses], [masks[i] for i in misses])
+            with self.timer.stage("cache_store"):
+                for i, composed_image in zip(misses, computed):
+                    self.cache.put(keys[i], composed_image)
+                    composed_images[i] = composed_image
+        return np.stack(composed_images)
+
+    def forward_composed_images(self, original_images, masked_images, masks):
+        # the crops are already in the [-1, 1] range of the generator, see crop_batch
+        with self.timer.stage("transform"):
+            mask_tensor = torch.from_numpy(np.asarray(masks))
+            original_tensor = torch.from_numpy(np.asarray(original_images, dtype=np.float32)[:, None])
+            input_tensor = torch.from_numpy(np.asarray(masked_images, dtype=np.float32)[:, None])
+
+        with self.timer.stage("h2d"):
+            mask_tensor = mask_tensor.float().to(self.device)
+            input_tensor = input_tensor.float().to(self.device)
+            original_tensor = original_tensor.float().to(self.device)
+        with self.timer.stage("forward"):
+            composed_output = self.backend(input_tensor, mask_tensor)
+        with self.timer.stage("compose"):
+            composed_image = composed_output * mask_tensor + original_tensor * (1 - mask_tensor)
+        with self.timer.stage("d2h"):
+            composed_image_np = composed_image.cpu().numpy()[:, 0]
         return composed_image_np
 
-    def predict(self, *, input_image: SimpleITK.Image) -> SimpleITK.Image:
-        input_image = SimpleITK.GetArrayFromImage(input_image)
-        total_time = time.time()
-        if len(input_image.shape) == 2:
-            input_image = np.expand_dims(input_image, 0)
-
-        nodule_images = np.zeros(input_image.shape)
-
-        for j in range(len(input_image)):
-            t = time.time()
-            cxr_img_scaled = input_image[j, :, :]
-            cxr_img_scaled = normalize_cxr(cxr_img_scaled)
-            nodule_data = [i for i in self.data['boxes'] if i['corners'][0][2] == j]
-
-            # loop over different images
-            for nodule in nodule_data:
-                boxes = nodule['corners']
-                x_min, y_min, x_max, y_max = boxes[2][0], boxes[2][1], boxes[0][0], boxes[0][1]
-                mask_bbox = [int(x_min), int(y_min), int(x_max) - int(x_min), int(y_max) - int(y_min)]
-
-                cropped_cxr, new_mask_bbox, crop_bbox = crop_around_mask_bbox(cxr_img_scaled, mask_bbox)
-                cropped_masked_cxr, cropped_mask = mask_image(cropped_cxr, new_mask_bbox)
-                composed_img = self.generate_composed_image(cropped_cxr, cropped_masked_cxr, cropped_mask)
-
-                c_x1, c_y1, c_w, c_h = crop_bbox
-                cxr_img_scaled[c_y1: c_y1+c_h, c_x1: c_x1+c_w] = (composed_img + 1) / 2  # undo normalization on output
-
-            print("time for image: ", time.time()-t)
-            result = cxr_img_scaled.copy()
-            result *= 255  # same normalization they did as in the baseline
-            nodule_images[j, :, :] = result
-        print('total time took ', time.time()-total_time)
-        return SimpleITK.GetImageFromArray(nodule_images)
+    def generate_composed_image(self, original_image, masked_image, mask):
+        return self.generate_composed_images([original_image], [masked_image], [mask])[0]
+
+    def image_view(self, input_image: SimpleITK.Image):
+        # read only view of the pixels of input_image, only valid as long as input_image exists
+        cxr_imgs = SimpleITK.GetArrayViewFromImage(input_image)
+        if len(cxr_imgs.shape) == 2:
+            cxr_imgs = np.expand_dims(cxr_imgs, 0)
+        return cxr_imgs
+
+    def prepare_image(self, input_image: SimpleITK.Image, nodule_index=None):
+        """Normalizes the stack into the output array and plans the crops of all its slices,
+        for the boxes of nodule_index (defaults to the boxes of nodules.json)."""
+        if nodule_index is None:
+            nodule_index = self.nodule_index
+        # crops are taken from the unmodified input and normalized on their own
+        cxr_imgs = self.image_view(input_image)
+        with self.timer.stage("normalize"):
+            nodule_images = normalize_cxr(cxr_imgs, out=np.empty(cxr_imgs.shape, dtype=self.compose_dtype))
+        with self.timer.stage("box_lookup"):
+            batches = self.plan_batches([(j, nodule_index[j].tolist()) for j in range(len(cxr_imgs))])
+        return cxr_imgs, nodule_images, batches
+
+    def plan_batches(self, slice_bboxes):
+        crop_jobs = []
+        for j, mask_bboxes in slice_bboxes:
+            if self.coalesce_crops:
+                crops = plan_crops(mask_bboxes, self.crop_size)
+            else:
+                crops = [(mask_bbox, [mask_bbox]) for mask_bbox in mask_bboxes]
+            crop_jobs += [(j, crop_mask_bbox, members, self.job_crop_size(crop_mask_bbox))
+                          for crop_mask_bbox, members in crops]
+
+        # batches only hold crops of the same size
+        batches = []
+        crop_jobs.sort(key=lambda job: job[3])
+        for _, size_jobs in groupby(crop_jobs, key=lambda job: job[3]):
+            size_jobs = list(size_jobs)
+            batches += [size_jobs[i: i + self.batch_size] for i in range(0, len(size_jobs), self.batch_size)]
+        return batches
+
+    def job_crop_size(self, crop_mask_bbox):
+        if self.crop_margin is None:
+            return self.crop_size
+        return adaptive_crop_size(crop_mask_bbox, self.crop_margin, self.crop_size)
+
+    def crop_window(self, image_shape, crop_mask_bbox, crop_size):
+        if crop_size < self.crop_size:
+            # the window is placed around the margin, so it is not cut off on one side
+            crop_mask_bbox = pad_bbox(crop_mask_bbox, self.crop_margin, image_shape)
+        return crop_window(image_shape, crop_mask_bbox, crop_size=crop_size)
+
+    def crop_batch(self, cxr_imgs, batch_jobs):
+        # the crops of a batch are normalized straight into one float32 buffer in the range of the generator,
+        # the mask value 1 of mask_image_bboxes is the same in that range
+        crop_size = batch_jobs[0][3]
+        cropped_cxrs = np.empty((len(batch_jobs), crop_size, crop_size), dtype=np.float32)
+        cropped_masked_cxrs, cropped_masks, crop_bboxes = [], [], []
+        for cropped_cxr, (j, crop_mask_bbox, mask_bboxes, _) in zip(cropped_cxrs, batch_jobs):
+            with self.timer.stage("crop"):
+                crop_bbox = self.crop_window(cxr_imgs[j].shape, crop_mask_bbox, crop_size)
+                cxr_to_model_range(crop_to_bbox(cxr_imgs[j], [crop_bbox[1], crop_bbox[0], crop_size, crop_size]),
+                                   out=cropped_cxr)
+            with self.timer.stage("mask"):
+                c_x, c_y = crop_bbox[0], crop_bbox[1]
+                new_mask_bboxes = [[x - c_x, y - c_y, w, h] for x, y, w, h in mask_bboxes]
+                cropped_masked_cxr, cropped_mask = mask_image_bboxes(cropped_cxr, new_mask_bboxes)
+            cropped_masked_cxrs.append(cropped_masked_cxr)
+            cropped_masks.append(cropped_mask)
+            crop_bboxes.append(crop_bbox)
+        return cropped_cxrs, cropped_masked_cxrs, cropped_masks, crop_bboxes
+
+    def generate_batch(self, nodule_images, batch_jobs, cropped_batch):
+        cropped_cxrs, cropped_masked_cxrs, cropped_masks, crop_bboxes = cropped_batch
+        composed_imgs = self.generate_composed_images(cropped_cxrs, cropped_masked_cxrs, cropped_masks)
+
+        # crops are always taken from the unmodified slices so the result does not depend on the batch size,
+        # outside of the mask the composed crop equals the input crop, so only the boxes are written back
+        with self.timer.stage("write_back"):
+            for (j, _, mask_bboxes, _), crop_bbox, composed_img in zip(batch_jobs, crop_bboxes, composed_imgs):
+                c_x, c_y = crop_bbox[0], crop_bbox[1]
+                for x, y, w, h in mask_bboxes:
+                    n_x, n_y = x - c_x, y - c_y
+                    nodule_images[j, y: y+h, x: x+w] = (composed_img[n_y: n_y+h, n_x: n_x+w] + 1) / 2  # undo normalization on output
+
+    def generate_batches(self, cxr_imgs, nodule_images, batches):
+        if self.tensor_pipeline:
+            return self.generate_batches_on_device(nodule_images, batches)
+        # crops are only materialized once their batch is forwarded
+        for batch_jobs in batches:
+            self.generate_batch(nodule_images, batch_jobs, self.crop_batch(cxr_imgs, batch_jobs))
+
+    def generate_batches_on_device(self, nodule_images, batches):
+        """generate_batch for all batches, with the crops cut, masked and composed on self.device."""
+        if not batches:
+            return
+        with self.timer.stage("h2d"):
+            stack = torch.from_numpy(nodule_images).to(self.device, torch.float32)
+            # crops are taken from the unmodified stack, as in crop_batch
+            composed_stack = stack.clone()
+        for batch_jobs in batches:
+            self.generate_batch_on_device(stack, composed_stack, batch_jobs)
+        with self.timer.stage("d2h"):
+            composed_stack = composed_stack.cpu().numpy()
+        # only the boxes are copied, so outside of them nodule_images keeps its own precision
+        with self.timer.stage("write_back"):
+            for batch_jobs in batches:
+                for j, _, mask_bboxes, _ in batch_jobs:
+                    for x, y, w, h in mask_bboxes:
+                        nodule_images[j, y: y+h, x: x+w] = composed_stack[j, y: y+h, x: x+w]
+
+    def generate_batch_on_device(self, stack, composed_stack, batch_jobs):
+        crop_size = batch_jobs[0][3]
+        with self.timer.stage("crop"):
+            crop_bboxes = [self.crop_window(stack.shape[1:], crop_mask_bbox, crop_size)
+                           for _, crop_mask_bbox, _, _ in batch_jobs]
+            # (batch, crop_size, crop_size) indices of the crop pixels in the stack
+            offsets = torch.arange(crop_size, device=self.device)
+            slices = torch.tensor([job[0] for job in batch_jobs], device=self.device)[:, None, None]
+            rows = torch.tensor([crop_bbox[1] for crop_bbox in crop_bboxes], device=self.device)[:, None] + offsets
+            cols = torch.tensor([crop_bbox[0] for crop_bbox in crop_bboxes], device=self.device)[:, None] + offsets
+            original_tensor = stack[slices, rows[:, :, None], cols[:, None, :]][:, None] * 2 - 1  # as cxr_to_model_range
+        with self.timer.stage("mask"):
+            boxes = [[k, x - c_x, y - c_y, w, h]
+                     for k, ((_, _, mask_bboxes, _), (c_x, c_y, _, _)) in enumerate(zip(batch_jobs, crop_bboxes))
+                     for x, y, w, h in mask_bboxes]
+            mask_tensor = box_masks(torch.tensor(boxes, device=self.device), len(batch_jobs), crop_size)
+            # masked pixels are set to 1, as in crop_batch
+            input_tensor = original_tensor * (1 - mask_tensor) + mask_tensor
+        with self.timer.stage("forward"):
+            composed_output = self.backend(input_tensor, mask_tensor)
+        with self.timer.stage("compose"):
+            composed_image = (composed_output * mask_tensor + original_tensor * (1 - mask_tensor) + 1) / 2
+            # box by box in job order, so overlapping boxes end up as in generate_batch
+            for k, n_x, n_y, w, h in boxes:
+                c_x, c_y = crop_bboxes[k][0], crop_bboxes[k][1]
+                j = batch_jobs[k][0]
+                composed_stack[j, c_y+n_y: c_y+n_y+h, c_x+n_x: c_x+n_x+w] = composed_image[k, 0, n_y: n_y+h, n_x: n_x+w]
+
+    def scale_output(self, nodule_images):
+        """Scales composed images in place to the output range, rounded and clipped for integer output dtypes."""
+        nodule_images *= 255  # same normalization they did as in the baseline
+        if self.output_dtype.kind != "f":
+            info = np.iinfo(self.output_dtype)
+            np.clip(np.rint(nodule_images, out=nodule_images), info.min, info.max, out=nodule_images)
+        return nodule_images
+
+    def finalize_image(self, nodule_images) -> SimpleITK.Image:
+        return SimpleITK.GetImageFromArray(self.scale_output(nodule_images).astype(self.output_dtype, copy=False))
+
+    def generate_image(self, input_image: SimpleITK.Image, nodule_index=None):
+        cxr_imgs, nodule_images, batches = self.prepare_image(input_image, nodule_index)
+        self.generate_batches(cxr_imgs, nodule_images, batches)
+        return nodule_images
+
+    def predict(self, *, input_image: SimpleITK.Image, nodule_index=None) -> SimpleITK.Image:
+        return self.finalize_image(self.generate_image(input_image, nodule_index))
+
+    def stream_case(self, input_image: SimpleITK.Image, output_path, nodule_index=None):
+        """predict + SimpleITK.WriteImage, one slice at a time."""
+        if nodule_index is None:
+            nodule_index = self.nodule_index
+        cxr_imgs = self.image_view(input_image)
+        with MhaSliceWriter(output_path, cxr_imgs.shape, self.output_dtype) as writer:
+            nodule_image = np.empty((1,) + cxr_imgs.shape[1:], dtype=self.compose_dtype)
+            for j in range(len(cxr_imgs)):
+                # the slice is processed as a stack of one
+                cxr_img = cxr_imgs[j: j + 1]
+                with self.timer.stage("normalize"):
+                    normalize_cxr(cxr_img, out=nodule_image)
+                with self.timer.stage("box_lookup"):
+                    batches = self.plan_batches([(0, nodule_index[j].tolist())])
+                self.generate_batches(cxr_img, nodule_image, batches)
+                with self.timer.stage("write"):
+                    writer.write(self.scale_output(nodule_image)[0])
+
+    def _load_input_image(self, *, case):
+        with self.timer.stage("decode"):
+            return super()._load_input_image(case=case)
+
+    def process_case(self, *, idx, case):
+        # same as SegmentationAlgorithm.process_case, with the stages timed
+        with self.timer.image(Path(case["path"]).name):
+            input_image, input_image_file_path = self._load_input_image(case=case)
+            if not self.stream_output:
+                return self.write_case(input_image_file_path, self.generate_image(input_image))
+            segmentation_path = self._output_path / input_image_file_path.name
+            if not self._output_path.exists():
+                self._output_path.mkdir()
+            self.stream_case(input_image, segmentation_path)
+        self.timer.finish(input_image_file_path.name)
+        return self.case_result(segmentation_path, input_image_file_path)
+
+    def read_case(self, case):
+        with self.timer.image(Path(case["path"]).name):
+            input_image, input_image_file_path = self._load_input_image(case=case)
+            cxr_imgs, nodule_images, batches = self.prepare_image(input_image)
+        # input_image is returned as well, cxr_imgs is a view of its pixels
+        return input_image, input_image_file_path, cxr_imgs, nodule_images, batches
+
+    def crop_batches_ahead(self, croppers, key, cxr_imgs, batches):
+        """Yields the batch jobs and crops of batches, cut by croppers at most pipeline_depth batches ahead."""
+        def crop_batch(batch_jobs):
+            with self.timer.image(key):
+                return self.crop_batch(cxr_imgs, batch_jobs)
+
+        cropped_batches = deque()
+        for batch_jobs in batches:
+            cropped_batches.append((batch_jobs, croppers.submit(crop_batch, batch_jobs)))
+            if len(cropped_batches) > self.pipeline_depth:
+                batch_jobs, cropped_batch = cropped_batches.popleft()
+                yield batch_jobs, cropped_batch.result()
+        while cropped_batches:
+            batch_jobs, cropped_batch = cropped_batches.popleft()
+            yield batch_jobs, cropped_batch.result()
+
+    def write_case(self, input_image_file_path, nodule_images):
+        """Writes the output of an image and ends its timing record."""
+        segmentation_path = self._output_path / input_image_file_path.name
+        if not self._output_path.exists():
+            self._output_path.mkdir()
+        with self.timer.image(input_image_file_path.name), self.timer.stage("write"):
+            # the same file as SimpleITK.WriteImage(self.finalize_image(nodule_images), path, True),
+            # without a SimpleITK copy of the whole stack
+            with MhaSliceWriter(segmentation_path, nodule_images.shape, self.output_dtype) as writer:
+                for nodule_image in nodule_images:
+                    writer.write(self.scale_output(nodule_image))
+        self.timer.finish(input_image_file_path.name)
+        return self.case_result(segmentation_path, input_image_file_path)
+
+    def case_result(self, segmentation_path, input_image_file_path):
+        # same output as SegmentationAlgorithm.process_case
+        return {
+            "outputs": [
+                dict(type="metaio_image", filename=segmentation_path.name)
+            ],
+            "inputs": [
+                dict(type="metaio_image", filename=input_image_file_path.name)
+            ],
+            "error_messages": [],
+        }
+
+    def process_cases(self, file_loader_key: str = None):
+        if self.pipeline_depth <= 0:
+            return super().process_cases(file_loader_key)
+        if file_loader_key is None:
+            file_loader_key = self._index_key
+
+        # readers decode and normalize the next images while the generator runs on the current one,
+        # at most pipeline_depth images are waiting in each of the read and write queues. The crops are cut
+        # by separate threads at most pipeline_depth batches ahead of the generator, not for whole images
+        cases = (case for _, case in self._cases[file_loader_key].iterrows())
+        read_queue = deque()
+        written = []
+        with ThreadPoolExecutor(max_workers=self.num_readers) as readers, \
+                ThreadPoolExecutor(max_workers=self.num_readers) as croppers, \
+                ThreadPoolExecutor(max_workers=1) as writer:
+            for case in cases:
+                read_queue.append(readers.submit(self.read_case, case))
+                if len(read_queue) == self.pipeline_depth:
+                    break
+
+            while read_queue:
+                input_image, input_image_file_path, cxr_imgs, nodule_images, batches = read_queue.popleft().result()
+                for case in cases:
+                    read_queue.append(readers.submit(self.read_case, case))
+                    break
+
+                key = input_image_file_path.name
+                with self.timer.image(key):
+                    for batch_jobs, cropped_batch in self.crop_batches_ahead(croppers, key, cxr_imgs, batches):
+                        self.generate_batch(nodule_images, batch_jobs, cropped_batch)
+                del input_image, cxr_imgs
+
+                if len(written) >= self.pipeline_depth:
+                    written[-self.pipeline_depth].result()
+                written.append(writer.submit(self.write_case, input_image_file_path, nodule_images))
+
+            self._case_results = [result.result() for result in written]
+
+    def save(self):
+        super().save()
+        self.timer.close()
+        self.backend.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+"""Keeps a Nodulegeneration model loaded and serves it over HTTP on localhost.
+
+POST /generate with a JSON body
+    {"input": "<path of the .mha image>", "output": "<path to write the result to>", "nodules": <nodules.json content>}
+runs the generator on the boxes of "nodules" and writes the composed image to "output", the response is
+    {"output": "<path>", "time": <seconds>, "stages": <seconds per stage, see model_submission/utils/timing.py>}
+GET /health answers {"status": "ok"} once the model is loaded. Requests are handled one at a time.
+client.py sends the images of an input directory to a running server.
+"""
+import argparse
+import json
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import SimpleITK
+
+from model_submission.utils.nodules import NoduleIndex
+from process import Nodulegeneration
+
+
+class NodulegenerationHandler(BaseHTTPRequestHandler):
+    def send_json(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self.send_json(404, {"error": f"unknown path {self.path}"})
+        self.send_json(200, {"status": "ok"})
+
+    def do_POST(self):
+        if self.path != "/generate":
+            return self.send_json(404, {"error": f"unknown path {self.path}"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            input_path, output_path = request["input"], request["output"]
+            nodule_index = NoduleIndex(request["nodules"])
+        except (KeyError, TypeError, ValueError) as e:
+            return self.send_json(400, {"error": f"invalid request: {e!r}"})
+
+        timer = self.server.algorithm.timer
+        try:
+            with timer.image(input_path):
+                with timer.stage("decode"):
+                    input_image = SimpleITK.ReadImage(input_path)
+                output_image = self.server.algorithm.predict(input_image=input_image, nodule_index=nodule_index)
+                with timer.stage("write"):
+                    SimpleITK.WriteImage(output_image, output_path, True)
+        except Exception as e:
+            timer.finish(input_path)
+            return self.send_json(500, {"error": repr(e)})
+        record = timer.finish(input_path)
+        self.send_json(200, {"output": output_path, "time": record["wall_s"], "stages": record["stages"]})
+
+
+def serve(algorithm, host="127.0.0.1", port=8642):
+    server = HTTPServer((host, port), NodulegenerationHandler)
+    server.algorithm = algorithm
+    print(f"serving on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        algorithm.timer.close()
+        algorithm.backend.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8642)
+    parser.add_argument('--options', type=json.loads, default={},
+                        help='keyword arguments of Nodulegeneration as JSON, e.g. \'{"backend": "onnx"}\'')
+    opt = parser.parse_args()
+
+    serve(Nodulegeneration(nodules_path=None, **opt.options), opt.host, opt.port)